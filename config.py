@@ -32,4 +32,6 @@ INSTA_COOKIES = os.getenv("INSTA_COOKIES", INST_COOKIES)
 FREEMIUM_LIMIT = int(os.getenv("FREEMIUM_LIMIT", "0"))
 PREMIUM_LIMIT = int(os.getenv("PREMIUM_LIMIT", "50000"))
 JOIN_LINK = os.getenv("JOIN_LINK", "https://t.me/team_spy_pro") # this link for start command message
-ADMIN_CONTACT = os.getenv("ADMIN_CONTACT", "https://t.me/username_of_admin")
\ No newline at end of file
+ADMIN_CONTACT = os.getenv("ADMIN_CONTACT", "https://t.me/username_of_admin")
+BATCH_WORKERS = max(1, int(os.getenv("BATCH_WORKERS", "1"))) # concurrent messages per batch; above 1, target order is not kept
+STREAM_UPLOAD = os.getenv("STREAM_UPLOAD", "false").lower() == "true" # pipe downloads straight into uploads (no disk, no thumbnails/rename)
\ No newline at end of file
@@ -1,44 +1,157 @@
 import asyncio
+
+try:
+    # Must be installed before shared_client builds its clients: pyrogram and
+    # telethon bind to the event loop that exists at construction time.
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
 from shared_client import start_client
+import copy
 import importlib
+import importlib.util
+import logging
+import logging.handlers
 import os
+import pkgutil
+import queue
+import signal
 import sys
-from utils.func import init_db_collections # Import init_db_collections
+from utils.func import init_db_collections, db_manager # Import init_db_collections
+
+logger = logging.getLogger(__name__)
+
+PLUGIN_EXCLUDES = frozenset({"__init__"})
+PLUGIN_SUFFIXES = frozenset({".py", ".pyc"})  # .pyc for sourceless (compiled-only) deployments
+
+_PLUGIN_CACHE = {}
+_PLUGIN_FINDERS = {}
+_PLUGINS_LOADED = False
+# Plugins that register no handlers at import time; reachable lazily as plugins.<name>
+ON_DEMAND_PLUGINS = frozenset({"pay"})
+
+class _LoopQueueHandler(logging.handlers.QueueHandler):
+    # The stdlib prepare() runs self.format(), traceback included, on the emitting thread.
+    # Only the message is merged here (so later changes to args can't leak in); the
+    # listener's handlers format exc_info on their own thread.
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+def setup_logging():
+    # Route records through a queue so handler I/O happens on the listener thread,
+    # not on the event loop.
+    root = logging.getLogger()
+    handlers = root.handlers[:] or [logging.StreamHandler()]
+    for handler in handlers:
+        root.removeHandler(handler)
+    log_queue = queue.SimpleQueue()
+    root.addHandler(_LoopQueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+def discover_plugins(plugin_dir):
+    # Cache keyed on the directory mtime so a re-scan only happens when plugins change
+    key = (plugin_dir, os.stat(plugin_dir).st_mtime_ns)
+    plugins = _PLUGIN_CACHE.get(key)
+    if plugins is None:
+        names = {}
+        with os.scandir(plugin_dir) as entries:
+            for entry in entries:
+                stem, ext = os.path.splitext(entry.name)
+                if ext in PLUGIN_SUFFIXES and stem not in PLUGIN_EXCLUDES and entry.is_file():
+                    names[stem] = None
+        plugins = tuple(names)
+        _PLUGIN_CACHE.clear()
+        _PLUGIN_CACHE[key] = plugins
+    return plugins
+
+def import_plugin(plugin, plugin_dir="plugins"):
+    # sys.modules fast path: never re-exec a plugin body (handlers would register twice)
+    fq = f"plugins.{plugin}"
+    module = sys.modules.get(fq)
+    if module is not None:
+        return module
+
+    # One path entry finder for the plugin directory, reused for every plugin
+    finder = _PLUGIN_FINDERS.get(plugin_dir)
+    if finder is None:
+        finder = _PLUGIN_FINDERS[plugin_dir] = pkgutil.get_importer(os.path.abspath(plugin_dir))
+    spec = finder.find_spec(fq) if finder is not None else None
+    if spec is None:
+        return importlib.import_module(fq)
+
+    package = importlib.import_module("plugins")
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[fq] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        sys.modules.pop(fq, None)
+        raise
+    setattr(package, plugin, module)
+    return module
+
+async def load_and_run_plugins(force=False):
+    global _PLUGINS_LOADED
+    if _PLUGINS_LOADED and not force:
+        return
 
-async def load_and_run_plugins():
     # Inisialisasi database sebelum memulai klien dan plugin
     await init_db_collections() # Panggil fungsi inisialisasi database di sini
     
     await start_client()
     plugin_dir = "plugins"
-    plugins = [f[:-3] for f in os.listdir(plugin_dir) if f.endswith(".py") and f != "__init__.py"]
+    discovered = await asyncio.to_thread(discover_plugins, plugin_dir)
+    plugins = [p for p in discovered if p not in ON_DEMAND_PLUGINS]
 
-    for plugin in plugins:
-        module = importlib.import_module(f"plugins.{plugin}")
-        if hasattr(module, f"run_{plugin}_plugin"):
-            print(f"Running {plugin} plugin...")
-            await getattr(module, f"run_{plugin}_plugin")()  
+    # Imports stay on the loop thread: plugins register their handlers at import time
+    # and the clients' dispatchers are not thread safe.
+    targets = [(plugin, import_plugin(plugin), f"run_{plugin}_plugin") for plugin in plugins]
+
+    runners = []
+    for plugin, module, name in targets:
+        fn = getattr(module, name, None)
+        if fn is not None:
+            logger.info("Running %s plugin...", plugin)
+            runners.append(fn())
+    await asyncio.gather(*runners)
+    _PLUGINS_LOADED = True
 
 async def main():
-    await load_and_run_plugins()
-    while True:
-        await asyncio.sleep(1)  
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass  # Windows: fall back to KeyboardInterrupt
+    try:
+        await load_and_run_plugins()
+        await stop.wait()
+        logger.info("Shutting down...")
+    finally:
+        await db_manager.close()
 
 if __name__ == "__main__":
+    listener = setup_logging()
     loop = asyncio.get_event_loop()
-    print("Starting clients ...")
+    logger.info("Starting clients ...")
     try:
         loop.run_until_complete(main())
     except KeyboardInterrupt:
-        print("Shutting down...")
+        logger.info("Shutting down...")
     except Exception as e:
-        print(e)
+        logger.exception(e)
         sys.exit(1)
     finally:
         try:
-            # Anda mungkin juga ingin menambahkan `await db_manager.close()` di sini
-            # jika `db_manager` di `utils.func` adalah singleton dan perlu ditutup eksplisit.
-            # Namun, aiosqlite cukup baik dalam mengelola ini secara internal saat program berakhir.
             loop.close()
         except Exception:
             pass
+        listener.stop()
@@ -1,62 +1,171 @@
 #plugins/batchch.py
-import os, re, time, asyncio, json, asyncio 
-from pyrogram import Client, filters
+import os, time, asyncio, orjson, weakref, hashlib, tempfile, logging
+from contextlib import asynccontextmanager, nullcontext, suppress
+from pathlib import Path
+from functools import lru_cache, partial
+from aiolimiter import AsyncLimiter
+from pyrogram import Client, filters, raw, utils as pyro_utils
 from pyrogram.types import Message
-from pyrogram.errors import UserNotParticipant
-from config import API_ID, API_HASH, LOG_GROUP, STRING, FORCE_SUB, FREEMIUM_LIMIT, PREMIUM_LIMIT
-from utils.func import get_user_data, screenshot, thumbnail, get_video_metadata
-from utils.func import get_user_data_key, process_text_with_rules, is_premium_user, E
+from pyrogram.errors import UserNotParticipant, FloodWait
+from config import API_ID, API_HASH, LOG_GROUP, STRING, FORCE_SUB, FREEMIUM_LIMIT, PREMIUM_LIMIT, STREAM_UPLOAD, BATCH_WORKERS
+from utils.func import get_user_cfg, screenshot, thumbnail, get_video_metadata
+from utils.func import process_text_with_rules, get_user_rules, is_premium_user, E
 from shared_client import app as X
 from plugins.settings import rename_file
 from plugins.start import subscribe as sub
 from utils.custom_filters import login_in_progress
 from utils.encrypt import dcs
+from utils.cache import TTLCache
 from typing import Dict, Any, Optional
 
 
+logger = logging.getLogger(__name__)
+
 Y = None if not STRING else __import__('shared_client').userbot
-Z, P, UB, UC, emp = {}, {}, {}, {}, {}
+Z, P, emp = {}, {}, {}
+
+# Per-user clients each hold an MTProto connection; idle ones are stopped and dropped
+CLIENT_CACHE_SIZE = 500
+CLIENT_IDLE_TTL = 1800  # seconds
+_BG_TASKS = set()
+
+async def _stop_client(cl):
+    try:
+        if cl.is_connected:
+            await cl.stop()
+    except Exception as e:
+        logger.warning("Error stopping evicted client: %s", e)
+
+def _spawn(coro):
+    task = asyncio.get_running_loop().create_task(coro)
+    _BG_TASKS.add(task)
+    task.add_done_callback(_BG_TASKS.discard)
+    return task
+
+def _evict_client(uid, cl):
+    _spawn(_stop_client(cl))
+
+def _client_pinned(uid):
+    return is_user_active(uid)  # never pull a client out from under a running batch
+
+# Bot clients are pooled per token: users sharing one bot share one connection.
+# UB maps uid -> that shared client; _BOT_REFS tracks which uids still use a token.
+UB_BY_TOKEN: Dict[str, Client] = {}
+_BOT_REFS: Dict[str, set] = {}
+_UID_TOKEN: Dict[int, str] = {}
+
+def _drop_ubot_ref(uid):
+    # Returns the pooled client once its last user is gone, for the caller to stop
+    token = _UID_TOKEN.pop(uid, None)
+    refs = _BOT_REFS.get(token)
+    if refs is None:
+        return None
+    refs.discard(uid)
+    if refs:
+        return None
+    del _BOT_REFS[token]
+    return UB_BY_TOKEN.pop(token, None)
+
+def _on_ubot_evict(uid, bot):
+    stale = _drop_ubot_ref(uid)
+    if stale:
+        _spawn(_stop_client(stale))
+
+async def release_ubot(uid):
+    # Returns the session name of the pooled client if this was its last user and it was stopped
+    UB.pop(uid)
+    stale = _drop_ubot_ref(uid)
+    if stale is None:
+        return None
+    if stale.is_connected:
+        await stale.stop()
+    return stale.name
+
+def _bot_session_name(token):
+    # One session file per bot token, shared by every user of that bot; never the raw token
+    return f"bot_{hashlib.blake2b(token.encode(), digest_size=8).hexdigest()}"
+
+UB = TTLCache(CLIENT_CACHE_SIZE, CLIENT_IDLE_TTL, on_evict=_on_ubot_evict, pinned=_client_pinned)
+UC = TTLCache(CLIENT_CACHE_SIZE, CLIENT_IDLE_TTL, on_evict=_evict_client, pinned=_client_pinned)
 
 ACTIVE_USERS = {}
 ACTIVE_USERS_FILE = "active_users.json"
+ACTIVE_USERS_FLUSH_DELAY = 3  # seconds; coalesces progress updates into one write
+
+_dirty = asyncio.Event()
+_flusher_task = None
+_flush_lock = asyncio.Lock()  # one writer at a time on the shared .tmp file
 
 # fixed directory file_name problems 
+_SAN_TABLE = str.maketrans(dict.fromkeys('<>:"/\\|?*\'', '_'))
+
 def sanitize(filename):
-    return re.sub(r'[<>:"/\\|?*\']', '_', filename).strip(" .")[:255]
+    return filename.translate(_SAN_TABLE).strip(" .")[:255]
 
 def load_active_users():
     try:
         if os.path.exists(ACTIVE_USERS_FILE):
-            with open(ACTIVE_USERS_FILE, 'r') as f:
-                return json.load(f)
+            with open(ACTIVE_USERS_FILE, 'rb') as f:
+                return orjson.loads(f.read())
         return {}
     except Exception:
         return {}
 
+def _write_bytes_atomic(payload):
+    tmp = ACTIVE_USERS_FILE + ".tmp"
+    with open(tmp, 'wb') as f:
+        f.write(payload)
+    os.replace(tmp, ACTIVE_USERS_FILE)
+
 async def save_active_users_to_file():
     try:
-        with open(ACTIVE_USERS_FILE, 'w') as f:
-            json.dump(ACTIVE_USERS, f)
+        async with _flush_lock:
+            # Snapshot on the loop thread so the dict can't change mid-serialization
+            payload = orjson.dumps(ACTIVE_USERS)
+            await asyncio.to_thread(_write_bytes_atomic, payload)
     except Exception as e:
-        print(f"Error saving active users: {e}")
+        logger.error("Error saving active users: %s", e)
+
+async def _flusher():
+    while True:
+        await _dirty.wait()
+        await asyncio.sleep(ACTIVE_USERS_FLUSH_DELAY)
+        _dirty.clear()
+        await save_active_users_to_file()
+
+def _mark_dirty():
+    global _flusher_task
+    _dirty.set()
+    if _flusher_task is None or _flusher_task.done():
+        _flusher_task = asyncio.get_running_loop().create_task(_flusher())
 
 async def add_active_batch(user_id: int, batch_info: Dict[str, Any]):
     ACTIVE_USERS[str(user_id)] = batch_info
-    await save_active_users_to_file()
+    _mark_dirty()
+
+def try_reserve_active(user_id: int, batch_info: Dict[str, Any]) -> bool:
+    # Check-and-set with no await in between, so two handlers can't both start a task
+    key = str(user_id)
+    if key in ACTIVE_USERS:
+        return False
+    ACTIVE_USERS[key] = batch_info
+    _mark_dirty()
+    return True
 
 def is_user_active(user_id: int) -> bool:
     return str(user_id) in ACTIVE_USERS
 
 async def update_batch_progress(user_id: int, current: int, success: int):
-    if str(user_id) in ACTIVE_USERS:
-        ACTIVE_USERS[str(user_id)]["current"] = current
-        ACTIVE_USERS[str(user_id)]["success"] = success
-        await save_active_users_to_file()
+    info = ACTIVE_USERS.get(str(user_id))
+    if info is not None and (info.get("current") != current or info.get("success") != success):
+        info["current"] = current
+        info["success"] = success
+        _mark_dirty()
 
 async def request_batch_cancel(user_id: int):
     if str(user_id) in ACTIVE_USERS:
         ACTIVE_USERS[str(user_id)]["cancel_requested"] = True
-        await save_active_users_to_file()
+        _mark_dirty()
         return True
     return False
 
@@ -67,21 +176,130 @@ def should_cancel(user_id: int) -> bool:
 async def remove_active_batch(user_id: int):
     if str(user_id) in ACTIVE_USERS:
         del ACTIVE_USERS[str(user_id)]
-        await save_active_users_to_file()
+        if ACTIVE_USERS:
+            _mark_dirty()
+        else:
+            _dirty.clear()
+            await save_active_users_to_file()
 
 def get_batch_info(user_id: int) -> Optional[Dict[str, Any]]:
     return ACTIVE_USERS.get(str(user_id))
 
 ACTIVE_USERS = load_active_users()
 
+# Filesystem probes run in a worker thread so slow disks don't stall other batches
+_aio_exists = partial(asyncio.to_thread, os.path.exists)
+_aio_size = partial(asyncio.to_thread, os.path.getsize)
+
+def _unlink_all(paths):
+    for path in paths:
+        Path(path).unlink(missing_ok=True)
+
+THUMB_DIR = os.path.join(tempfile.gettempdir(), "thumbs")
+THUMB_MAX_AGE = 24 * 3600  # seconds a cached frame is kept
+THUMB_MAX_FILES = 2000  # newest frames kept once the directory grows past this
+THUMB_PRUNE_INTERVAL = 600  # seconds between directory sweeps
+_thumb_pruned = 0.0
+
+def _prune_thumbs():
+    try:
+        with os.scandir(THUMB_DIR) as it:
+            entries = [(e.stat().st_mtime, e.path) for e in it if e.is_file()]
+    except FileNotFoundError:
+        return
+    cutoff = time.time() - THUMB_MAX_AGE
+    entries.sort(reverse=True)
+    stale = [p for k, (mt, p) in enumerate(entries) if mt < cutoff or k >= THUMB_MAX_FILES]
+    _unlink_all(stale)
+
+async def cached_screenshot(f, dur, d):
+    # ffmpeg runs once per (file, duration, user); retries and re-sends reuse the stored frame
+    global _thumb_pruned
+    size = await _aio_size(f)
+    key = hashlib.blake2b(f"{os.path.basename(f)}:{size}:{dur}:{d}".encode(), digest_size=8).hexdigest()
+    path = os.path.join(THUMB_DIR, f"{key}.jpg")
+    if await _aio_exists(path):
+        return path
+    now = time.time()
+    if now - _thumb_pruned > THUMB_PRUNE_INTERVAL:
+        _thumb_pruned = now
+        await asyncio.to_thread(_prune_thumbs)
+    try:
+        await asyncio.to_thread(os.makedirs, THUMB_DIR, exist_ok=True)
+        # ffmpeg's frame is written straight to its cache path (atomically), never via a shared name
+        return await screenshot(f, dur or 1, d, output_file=path)
+    except OSError as e:
+        logger.warning("Could not cache thumbnail: %s", e)
+        return await screenshot(f, dur or 1, d)
+
+def _is_temp_thumb(th):
+    return bool(th) and not th.startswith(THUMB_DIR)
+
+@asynccontextmanager
+async def _cleanup_files(*paths, keep=None):
+    # Yields a list callers append temp files to; all of it is unlinked in one worker call on exit
+    files = [p for p in paths if p]
+    try:
+        yield files
+    finally:
+        files = [p for p in files if p and p != keep]
+        if files:
+            await asyncio.to_thread(_unlink_all, files)
+
+# Proactive throttling, kept under Telegram's ~30 msg/s per bot token and
+# ~20 msg/min per group. Every user brings their own bot, so buckets are per client.
+BOT_RATE = 25
+GROUP_RATE = 20
+_EDIT_LIMITERS = weakref.WeakKeyDictionary()
+_SEND_LIMITERS = weakref.WeakKeyDictionary()
+_CHAT_LIMITERS = TTLCache(4096, 600)  # chat -> bucket; an idle bucket is full again long before it expires
+
+def _limiter(pool, client):
+    lim = pool.get(client)
+    if lim is None:
+        lim = pool[client] = AsyncLimiter(BOT_RATE, 1)
+    return lim
+
+def _chat_limiter(chat_id):
+    key = str(chat_id)
+    if not key.startswith('-'):
+        return nullcontext()
+    lim = _CHAT_LIMITERS.get(key)
+    if lim is None:
+        lim = _CHAT_LIMITERS[key] = AsyncLimiter(GROUP_RATE, 60)
+    return lim
+
+async def _edit(c, chat_id, mid, text):
+    async with _limiter(_EDIT_LIMITERS, c):
+        return await c.edit_message_text(chat_id, mid, text)
+
 async def upd_dlg(c):
     try:
         async for _ in c.get_dialogs(limit=100): pass
         return True
     except Exception as e:
-        print(f'Failed to update dialogs: {e}')
+        logger.warning("Failed to update dialogs: %s", e)
         return False
 
+_PEERS = TTLCache(4096, 3600)  # (client name, chat) -> resolved chat id, shared across a batch
+
+_Y_READY = False
+_y_lock = asyncio.Lock()
+
+async def ensure_Y():
+    # Start the shared userbot if needed and prime its dialogs once, not per large file
+    global _Y_READY
+    if _Y_READY and Y.is_connected:
+        return
+    async with _y_lock:
+        if _Y_READY and Y.is_connected:
+            return
+        if not Y.is_connected:
+            await Y.start()
+        if not await upd_dlg(Y):
+            logger.warning("Userbot dialog update failed. Large file upload might fail.")
+        _Y_READY = True
+
 async def get_msg(c, u, i, d, lt):
     try:
         if lt == 'public':
@@ -93,54 +311,81 @@ async def get_msg(c, u, i, d, lt):
                     except: pass
                     xm = await u.get_messages((await u.get_chat(f"@{i}")).id, d)
                 return xm
+            except FloodWait:
+                raise  # the caller waits it out and retries; not a missing message
             except Exception as e:
-                print(f'Error fetching public message: {e}')
+                logger.warning("Error fetching public message: %s", e)
                 return None
         else:
             if u:
                 try:
-                    async for _ in u.get_dialogs(limit=50): pass
                     chat_id = i if str(i).startswith('-100') else f'-100{i}' if i.isdigit() else i
+                    key = (u.name, chat_id)
                     try:
-                        peer = await u.resolve_peer(chat_id)
-                        if hasattr(peer, 'channel_id'): resolved_id = f'-100{peer.channel_id}'
-                        elif hasattr(peer, 'chat_id'): resolved_id = f'-{peer.chat_id}'
-                        elif hasattr(peer, 'user_id'): resolved_id = peer.user_id
-                        else: resolved_id = chat_id
+                        resolved_id = _PEERS.get(key)
+                        if resolved_id is None:
+                            peer = await u.resolve_peer(chat_id)
+                            if hasattr(peer, 'channel_id'): resolved_id = f'-100{peer.channel_id}'
+                            elif hasattr(peer, 'chat_id'): resolved_id = f'-{peer.chat_id}'
+                            elif hasattr(peer, 'user_id'): resolved_id = peer.user_id
+                            else: resolved_id = chat_id
+                            _PEERS[key] = resolved_id
                         return await u.get_messages(resolved_id, d)
+                    except FloodWait:
+                        raise
                     except Exception:
+                        _PEERS.pop(key)
                         try:
                             chat = await u.get_chat(chat_id)
+                            _PEERS[key] = chat.id
                             return await u.get_messages(chat.id, d)
+                        except FloodWait:
+                            raise
                         except Exception:
                             async for _ in u.get_dialogs(limit=200): pass
                             return await u.get_messages(chat_id, d)
+                except FloodWait:
+                    raise
                 except Exception as e:
-                    print(f'Private channel error: {e}')
+                    logger.warning("Private channel error: %s", e)
                     return None
             return None
+    except FloodWait:
+        raise
     except Exception as e:
-        print(f'Error fetching message: {e}')
+        logger.error("Error fetching message: %s", e)
         return None
 
 async def get_ubot(uid):
-    bt = await get_user_data_key(uid, "bot_token", None)
+    bt = (await get_user_cfg(uid)).get("bot_token")
     if not bt: return None
-    if uid in UB: return UB.get(uid)
-    try:
-        bot = Client(f"user_{uid}", bot_token=bt, api_id=API_ID, api_hash=API_HASH)
-        await bot.start()
-        UB[uid] = bot
-        return bot
-    except Exception as e:
-        print(f"Error starting bot for user {uid}: {e}")
-        return None
+    bot = UB.get(uid)
+    if bot and _UID_TOKEN.get(uid) == bt and bot.is_connected: return bot
+    if bot or uid in _UID_TOKEN:
+        await release_ubot(uid)  # token changed or connection dropped
+    bot = UB_BY_TOKEN.get(bt)
+    if bot is None or not bot.is_connected:
+        try:
+            bot = Client(_bot_session_name(bt), bot_token=bt, api_id=API_ID, api_hash=API_HASH)
+            await bot.start()
+        except Exception as e:
+            logger.error("Error starting bot for user %s: %s", uid, e)
+            return None
+        UB_BY_TOKEN[bt] = bot
+        for other in _BOT_REFS.get(bt, ()):
+            UB[other] = bot  # users still sharing the token move off the dropped client
+    _BOT_REFS.setdefault(bt, set()).add(uid)
+    _UID_TOKEN[uid] = bt
+    UB[uid] = bot
+    return bot
 
 async def get_uclient(uid):
-    ud = await get_user_data(uid)
+    ud = await get_user_cfg(uid)
     ubot = UB.get(uid)
     cl = UC.get(uid)
-    if cl: return cl
+    if cl:
+        if cl.is_connected: return cl
+        UC.pop(uid)
     if not ud: return ubot if ubot else None
     xxx = ud.get('session_string')
     if xxx:
@@ -152,52 +397,227 @@ async def get_uclient(uid):
             UC[uid] = gg
             return gg
         except Exception as e:
-            print(f'User client error: {e}')
+            logger.warning("User client error: %s", e)
             return ubot if ubot else Y
     return Y
 
+PROG_MIN_INTERVAL = 3.0  # seconds between progress edits of one message
+_BARS = tuple('🟢' * i + '🔴' * (10 - i) for i in range(11))
+
+@lru_cache(maxsize=4096)
+def _fmt_eta(seconds):
+    return time.strftime('%M:%S', time.gmtime(seconds))
+
+# Progress state is keyed by (chat id, message id): message ids are only unique within a chat
+_PROG_DONE = set()  # progress messages that already show 100%
+_EDIT_PAUSE_UNTIL = TTLCache(4096, 3600)  # progress message -> time edits may resume after a FloodWait
+_LAST_FLOODWAIT = weakref.WeakKeyDictionary()  # client -> time of its most recent FloodWait
+
+def _note_floodwait(client):
+    _LAST_FLOODWAIT[client] = time.time()
+
+async def _after_flood(client, fn, *args, retry=False, **kwargs):
+    # For calls made once the media may already be delivered (status edits, cleanup,
+    # the final hop of a relay): wait out a FloodWait here instead of letting it make the
+    # worker redo the whole message. retry=True repeats the call, otherwise it is dropped.
+    while True:
+        try:
+            return await fn(*args, **kwargs)
+        except FloodWait as e:
+            _note_floodwait(client)
+            await asyncio.sleep(e.value)
+            if not retry:
+                return None
+
 async def prog(c, t, C, h, m, st):
     global P
+    key = (str(h), m)
+    tkey = (*key, 't')
+    now = time.time()
+    if now < _EDIT_PAUSE_UNTIL.get(key, 0):
+        return
+    if c != t and now - P.get(tkey, 0) < PROG_MIN_INTERVAL:
+        return
     p = c / t * 100
+    done = p >= 100
+    if done and key in _PROG_DONE:
+        return
     interval = 10 if t >= 100 * 1024 * 1024 else 20 if t >= 50 * 1024 * 1024 else 30 if t >= 10 * 1024 * 1024 else 50
     step = int(p // interval) * interval
-    if m not in P or P[m] != step or p >= 100:
-        P[m] = step
+    if key not in P or P[key] != step or done:
+        P[key] = step
+        P[tkey] = now
         c_mb = c / (1024 * 1024)
         t_mb = t / (1024 * 1024)
-        bar = '🟢' * int(p / 10) + '🔴' * (10 - int(p / 10))
-        speed = c / (time.time() - st) / (1024 * 1024) if time.time() > st else 0
-        eta = time.strftime('%M:%S', time.gmtime((t - c) / (speed * 1024 * 1024))) if speed > 0 else '00:00'
-        await C.edit_message_text(h, m, f"__**Pyro Handler...**__\n\n{bar}\n\n⚡**__Completed__**: {c_mb:.2f} MB / {t_mb:.2f} MB\n📊 **__Done__**: {p:.2f}%\n🚀 **__Speed__**: {speed:.2f} MB/s\n⏳ **__ETA__**: {eta}\n\n**__Powered by Team SPY__**")
-        if p >= 100: P.pop(m, None)
+        bar = _BARS[min(10, int(p / 10))]
+        speed = c / (now - st) / (1024 * 1024) if now > st else 0
+        eta = _fmt_eta(int((t - c) / (speed * 1024 * 1024))) if speed > 0 else '00:00'
+        try:
+            await _edit(C, h, m, f"__**Pyro Handler...**__\n\n{bar}\n\n⚡**__Completed__**: {c_mb:.2f} MB / {t_mb:.2f} MB\n📊 **__Done__**: {p:.2f}%\n🚀 **__Speed__**: {speed:.2f} MB/s\n⏳ **__ETA__**: {eta}\n\n**__Powered by Team SPY__**")
+        except FloodWait as e:
+            # Skip edits for this message until the wait is over instead of stalling the transfer
+            _EDIT_PAUSE_UNTIL[key] = now + e.value
+            _note_floodwait(C)
+            return
+        _EDIT_PAUSE_UNTIL.pop(key, None)
+        if done:
+            P.pop(key, None)
+            P.pop(tkey, None)
+            if len(_PROG_DONE) > 1024: _PROG_DONE.clear()  # keys of long-deleted progress messages
+            _PROG_DONE.add(key)
+        else:
+            _PROG_DONE.discard(key)  # same message reused for the next transfer
+
+# media attribute -> (send method, whether it takes a caption, extra kwargs from the media object)
+_SEND_MAP = (
+    ('video', 'send_video', True, lambda v: {'duration': v.duration, 'width': v.width, 'height': v.height}),
+    ('video_note', 'send_video_note', False, None),
+    ('voice', 'send_voice', False, None),
+    ('sticker', 'send_sticker', False, None),
+    ('audio', 'send_audio', True, lambda a: {'duration': a.duration, 'performer': a.performer, 'title': a.title}),
+    ('photo', 'send_photo', True, None),
+    ('document', 'send_document', True, lambda doc: {'file_name': doc.file_name}),
+)
 
 async def send_direct(c, m, tcid, ft=None, rtmid=None):
+    for attr, method, takes_caption, extra in _SEND_MAP:
+        media = getattr(m, attr, None)
+        if media:
+            break
+    else:
+        return False
+    file_id = media.file_id if hasattr(media, 'file_id') else media[-1].file_id
+    kw = extra(media) if extra else {}
+    if takes_caption:
+        kw['caption'] = ft
     try:
-        if m.video:
-            await c.send_video(tcid, m.video.file_id, caption=ft, duration=m.video.duration, width=m.video.width, height=m.video.height, reply_to_message_id=rtmid)
-        elif m.video_note:
-            await c.send_video_note(tcid, m.video_note.file_id, reply_to_message_id=rtmid)
-        elif m.voice:
-            await c.send_voice(tcid, m.voice.file_id, reply_to_message_id=rtmid)
-        elif m.sticker:
-            await c.send_sticker(tcid, m.sticker.file_id, reply_to_message_id=rtmid)
-        elif m.audio:
-            await c.send_audio(tcid, m.audio.file_id, caption=ft, duration=m.audio.duration, performer=m.audio.performer, title=m.audio.title, reply_to_message_id=rtmid)
-        elif m.photo:
-            photo_id = m.photo.file_id if hasattr(m.photo, 'file_id') else m.photo[-1].file_id
-            await c.send_photo(tcid, photo_id, caption=ft, reply_to_message_id=rtmid)
-        elif m.document:
-            await c.send_document(tcid, m.document.file_id, caption=ft, file_name=m.document.file_name, reply_to_message_id=rtmid)
-        else:
-            return False
+        async with _limiter(_SEND_LIMITERS, c), _chat_limiter(tcid):
+            await getattr(c, method)(tcid, file_id, reply_to_message_id=rtmid, **kw)
         return True
+    except FloodWait:
+        raise  # temporary: the batch worker backs off and retries the message
     except Exception as e:
-        print(f'Direct send error: {e}')
+        logger.warning("Direct send error: %s", e)
         return False
 
-async def process_msg(c, u, m, d, lt, uid, i):
+async def copy_direct(c, m, tcid, ft=None, rtmid=None):
+    # Server-side copy: one RPC, no per-type dispatch; fails on protected chats
     try:
-        cfg_chat = await get_user_data_key(d, 'chat_id', None)
+        async with _limiter(_SEND_LIMITERS, c), _chat_limiter(tcid):
+            await c.copy_message(tcid, m.chat.id, m.id, caption=ft or None, reply_to_message_id=rtmid)
+        return True
+    except FloodWait:
+        raise  # rate limited, not a copy restriction: must not land the chat in _COPY_DENIED
+    except Exception as e:
+        logger.info("Copy failed, falling back to direct send: %s", e)
+        return False
+
+BIG_FILE = 2 * 1024 * 1024 * 1024
+VIDEO_SUFFIXES = frozenset({'.mp4', '.mkv', '.avi'})
+IN_MEMORY_MAX = 4 * 1024 * 1024
+
+def _media_size(m):
+    for attr, _, _, _ in _SEND_MAP:
+        media = getattr(m, attr, None)
+        if media:
+            return getattr(media, 'file_size', 0) or 0
+    return 0
+
+async def relay_big_file(c, m, d, ft):
+    # >2GB: let the userbot copy server-side into LOG_GROUP instead of downloading and re-uploading
+    try:
+        await ensure_Y()
+        sent = await Y.copy_message(LOG_GROUP, m.chat.id, m.id, caption=ft or None)
+        await _after_flood(c, c.copy_message, d, LOG_GROUP, sent.id, retry=True)  # already in LOG_GROUP
+        return True
+    except FloodWait:
+        raise  # retrying later beats downloading a >2GB file
+    except Exception as e:
+        # RPC errors, dropped connections, a userbot that won't start: the download path still works
+        logger.warning("Server-side copy of large file failed, downloading instead: %s", e)
+        return False
+
+UPLOAD_PART = 512 * 1024
+BIG_UPLOAD = 10 * 1024 * 1024  # upload.saveBigFilePart is required above 10MB
+UPLOAD_PARALLEL = 4  # parts in flight at once; higher invites FLOOD_WAIT
+
+async def stream_upload(c, u, m, tcid, ft, rtmid, name, d, pid, st):
+    # Fused download/upload: chunks from u.stream_media go straight out as upload parts
+    media = m.video or m.audio or m.document
+    size = media.file_size
+    total = -(-size // UPLOAD_PART)
+    big = size > BIG_UPLOAD
+    file_id = c.rnd_id()
+    part = 0
+    done = [0]
+    slots = asyncio.Semaphore(UPLOAD_PARALLEL)
+    inflight = set()
+    errors = []
+
+    async def put(request, n):
+        try:
+            await c.invoke(request)
+            done[0] += n
+            await prog(done[0], size, c, d, pid, st)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            slots.release()
+
+    # Parts are independent server-side, so up to UPLOAD_PARALLEL are uploaded concurrently
+    async for chunk in u.stream_media(m):
+        for off in range(0, len(chunk), UPLOAD_PART):
+            data = chunk[off:off + UPLOAD_PART]
+            if big:
+                request = raw.functions.upload.SaveBigFilePart(file_id=file_id, file_part=part, file_total_parts=total, bytes=data)
+            else:
+                request = raw.functions.upload.SaveFilePart(file_id=file_id, file_part=part, bytes=data)
+            await slots.acquire()
+            if errors:
+                for t in inflight: t.cancel()
+                raise errors[0]
+            task = asyncio.create_task(put(request, len(data)))
+            inflight.add(task)
+            task.add_done_callback(inflight.discard)
+            part += 1
+    await asyncio.gather(*inflight)
+    if errors:
+        raise errors[0]
+    if big:
+        uploaded = raw.types.InputFileBig(id=file_id, parts=part, name=name)
+    else:
+        uploaded = raw.types.InputFile(id=file_id, parts=part, name=name, md5_checksum="")
+    attributes = [raw.types.DocumentAttributeFilename(file_name=name)]
+    if m.video:
+        attributes.append(raw.types.DocumentAttributeVideo(duration=m.video.duration or 0, w=m.video.width or 0, h=m.video.height or 0, supports_streaming=True))
+    elif m.audio:
+        attributes.append(raw.types.DocumentAttributeAudio(duration=m.audio.duration or 0, performer=m.audio.performer, title=m.audio.title))
+    async with _limiter(_SEND_LIMITERS, c), _chat_limiter(tcid):
+        await c.invoke(raw.functions.messages.SendMedia(
+            peer=await c.resolve_peer(int(tcid)),
+            media=raw.types.InputMediaUploadedDocument(file=uploaded, mime_type=media.mime_type or "application/octet-stream", attributes=attributes),
+            reply_to=raw.types.InputReplyToMessage(reply_to_msg_id=rtmid) if rtmid else None,
+            random_id=c.rnd_id(),
+            **await pyro_utils.parse_text_entities(c, ft or "", None, None)
+        ))
+
+# Uploads of downloaded files: media attribute (also the file kwarg) -> (send method, caption, thumb)
+_UPLOAD_MAP = (
+    ('video_note', 'send_video_note', False, False),
+    ('voice', 'send_voice', False, False),
+    ('audio', 'send_audio', True, True),
+    ('photo', 'send_photo', True, False),
+)
+_UPLOAD_DOCUMENT = ('document', 'send_document', True, False)
+
+_COPY_DENIED = TTLCache(4096, 3600)  # (bot name, chat id) where copy_message already failed
+
+async def process_msg(c, u, m, d, lt, uid, i, cfg=None, slot=None):
+    p = None
+    try:
+        if cfg is None:
+            cfg = await get_user_cfg(d)
+        cfg_chat, user_cap = cfg.get('chat_id'), cfg.get('caption', '')
         tcid = d # Default target chat ID is the user's chat ID
         rtmid = None
         if cfg_chat:
@@ -209,201 +629,337 @@ async def process_msg(c, u, m, d, lt, uid, i):
                 else:
                     tcid = int(cfg_chat)
             except ValueError:
-                print(f"Invalid chat_id format '{cfg_chat}', falling back to user chat_id.")
+                logger.warning("Invalid chat_id format '%s', falling back to user chat_id.", cfg_chat)
                 tcid = d # Fallback to user's chat if cfg_chat is invalid
         
         if m.media:
             orig_text = m.caption.markdown if m.caption else ''
             proc_text = await process_text_with_rules(d, orig_text)
-            user_cap = await get_user_data_key(d, 'caption', '')
-            ft = f'{proc_text}\n\n{user_cap}' if proc_text and user_cap else user_cap if user_cap else proc_text
+            ft = f'{proc_text}\n\n{user_cap}' if proc_text and user_cap else (proc_text or user_cap)
             
+            # Server-side copy whenever the source allows forwarding: no bytes go through us.
+            # Skipped for public posts only the user client could see (emp) and for chats the bot can't read.
+            reachable = not (lt == 'public' and emp.get(i, False))
+            protected = getattr(m, 'has_protected_content', False) or getattr(m.chat, 'has_protected_content', False)
+            copy_key = (c.name, m.chat.id)
+            if reachable and not protected and copy_key not in _COPY_DENIED:
+                if await copy_direct(c, m, tcid, ft, rtmid):
+                    return 'Copied.'
+                if lt != 'public':
+                    _COPY_DENIED[copy_key] = True
+
             # Direct send for public links (no download needed if not self-hosted)
-            if lt == 'public' and not emp.get(i, False):
+            if lt == 'public' and reachable:
                 # Ensure 'm' itself is not None and has the necessary media
                 if await send_direct(c, m, tcid, ft, rtmid):
                     return 'Sent directly.'
                 else:
                     # If direct send failed, we might still want to try download as fallback
-                    print("Direct send failed, attempting download as fallback.")
+                    logger.info("Direct send failed, attempting download as fallback.")
             
+            if Y and not protected and _media_size(m) > BIG_FILE:
+                if await relay_big_file(c, m, d, ft):
+                    return 'Done (Large file).'
+
             st = time.time()
             p = await c.send_message(d, 'Downloading...') # 'p' is the progress message
 
             # Determine file_name for download, ensure it's always set
-            file_name_base = f"{time.time()}"
-            ext = ""
-            if m.video:
-                ext = ".mp4"
-                if m.video.file_name:
-                    file_name_base = os.path.splitext(m.video.file_name)[0]
-            elif m.audio:
-                ext = ".mp3"
-                if m.audio.file_name:
-                    file_name_base = os.path.splitext(m.audio.file_name)[0]
-            elif m.document:
-                ext = os.path.splitext(m.document.file_name)[1] if m.document.file_name else ""
-                if m.document.file_name:
-                    file_name_base = os.path.splitext(m.document.file_name)[0]
-            elif m.photo:
-                ext = ".jpg"
+            video, audio, document = m.video, m.audio, m.document
+            media = video or audio or document
+            name = media.file_name if media else None
+            file_name_base, suffix = os.path.splitext(name) if name else (f"{time.time()}", "")
+            ext = ".mp4" if video else ".mp3" if audio else suffix if document else ".jpg" if m.photo else ""
             
             # Sanitize and ensure file_name is not empty
             c_name = sanitize(file_name_base) + ext
             if not c_name: # Fallback if sanitize makes it empty
                 c_name = f"downloaded_file_{int(time.time())}{ext or '.bin'}"
 
-            f = await u.download_media(m, file_name=c_name, progress=prog, progress_args=(c, d, p.id, st))
+            if STREAM_UPLOAD and (m.video or m.audio or m.document) and 0 < _media_size(m) <= BIG_FILE:
+                try:
+                    await stream_upload(c, u, m, tcid, ft, rtmid, c_name, d, p.id, st)
+                except Exception as e:
+                    if isinstance(e, FloodWait): _note_floodwait(c)
+                    logger.warning("Streamed upload failed, falling back to download: %s", e)
+                else:
+                    # Delivered: a failing status cleanup must not send the file a second time
+                    with suppress(Exception):
+                        await _after_flood(c, c.delete_messages, d, p.id)
+                    return 'Done.'
+
+            if (m.photo or m.voice) and 0 < _media_size(m) < IN_MEMORY_MAX:
+                # Small photo/voice: keep the bytes in memory, no temp file to write, rename or unlink
+                buf = await u.download_media(m, in_memory=True, progress=prog, progress_args=(c, d, p.id, st))
+                if not buf:
+                    await _after_flood(c, _edit, c, d, p.id, 'Failed to download file.')
+                    return 'Failed to download.'
+                buf.name = c_name
+                await _after_flood(c, _edit, c, d, p.id, 'Uploading...')
+                st = time.time()
+                try:
+                    async with _limiter(_SEND_LIMITERS, c), _chat_limiter(tcid):
+                        if m.photo:
+                            await c.send_photo(tcid, photo=buf, caption=ft, progress=prog, progress_args=(c, d, p.id, st), reply_to_message_id=rtmid)
+                        else:
+                            await c.send_voice(tcid, voice=buf, progress=prog, progress_args=(c, d, p.id, st), reply_to_message_id=rtmid)
+                except Exception as e:
+                    if isinstance(e, FloodWait): _note_floodwait(c)
+                    await _after_flood(c, _edit, c, d, p.id, f'Upload failed: {str(e)[:50]}')
+                    return 'Failed.'
+                await _after_flood(c, c.delete_messages, d, p.id)
+                return 'Done.'
+
+            # Batch workers each download into their own long-lived slot directory, so
+            # concurrent items with the same file name never overwrite each other
+            dl_name = os.path.join(slot, c_name) if slot else c_name
+            f = await u.download_media(m, file_name=dl_name, progress=prog, progress_args=(c, d, p.id, st))
             
-            if not f or not os.path.exists(f): # Crucial check if download failed
-                await c.edit_message_text(d, p.id, 'Failed to download file.')
+            if not f or not await _aio_exists(f): # Crucial check if download failed
+                await _after_flood(c, _edit, c, d, p.id, 'Failed to download file.')
                 return 'Failed to download.'
             
-            await c.edit_message_text(d, p.id, 'Renaming...')
+            await _after_flood(c, _edit, c, d, p.id, 'Renaming...')
             # Ensure 'f' is a string before passing to rename_file
             if isinstance(f, str):
                 renamed_f = await rename_file(f, d, p)
-                if renamed_f and os.path.exists(renamed_f): # Check if rename was successful
+                if renamed_f and await _aio_exists(renamed_f): # Check if rename was successful
                     f = renamed_f
                 else:
-                    print(f"Renaming failed or returned invalid path for {f}. Continuing with original path.")
+                    logger.warning("Renaming failed or returned invalid path for %s. Continuing with original path.", f)
                     # Keep original 'f' if rename failed. Log it if necessary.
             else:
-                print(f"Downloaded file path is not a string: {f}. Skipping rename.")
+                logger.warning("Downloaded file path is not a string: %s. Skipping rename.", f)
 
-            fsize = os.path.getsize(f) / (1024 * 1024 * 1024)
-            th = thumbnail(d) # This can return None, handle it later in send_media calls
+            fsize = await _aio_size(f) / (1024 * 1024 * 1024)
+            th = await asyncio.to_thread(thumbnail, d) # This can return None, handle it later in send_media calls
+            is_video = bool(m.video) or (isinstance(f, str) and os.path.splitext(f)[1].lower() in VIDEO_SUFFIXES)
 
-            # Handling large files (over 2GB) with userbot Y
-            if fsize > 2 and Y:
-                st = time.time()
-                await c.edit_message_text(d, p.id, 'File is larger than 2GB. Using alternative method...')
-                try:
-                    await upd_dlg(Y) # Ensure userbot dialogs are updated
-                except Exception as e:
-                    print(f"Userbot dialog update failed: {e}. Large file upload might fail.")
+            # Downloaded file and any generated screenshot are removed on every exit path
+            async with _cleanup_files(f, keep=f'{d}.jpg') as tmp:
+                # Handling large files (over 2GB) with userbot Y
+                if fsize > 2 and Y:
+                    st = time.time()
+                    await _after_flood(c, _edit, c, d, p.id, 'File is larger than 2GB. Using alternative method...')
+                    try:
+                        await ensure_Y()
+                    except Exception as e:
+                        logger.warning("Userbot start failed: %s. Large file upload might fail.", e)
 
-                dur, h, w = None, None, None
-                if m.video or (isinstance(f, str) and os.path.splitext(f)[1].lower() in ['.mp4', '.mkv', '.avi']): # Check for video extension
-                    mtd = await get_video_metadata(f)
-                    dur, h, w = mtd.get('duration'), mtd.get('height'), mtd.get('width')
-                    th = await screenshot(f, dur or 1, d) # Pass default duration if None
+                    dur, h, w = None, None, None
+                    if is_video:
+                        mtd = await get_video_metadata(f)
+                        dur, h, w = mtd.get('duration'), mtd.get('height'), mtd.get('width')
+                        th = await cached_screenshot(f, dur, d) # Pass default duration if None
+                        if _is_temp_thumb(th): tmp.append(th)
 
-                sent = None
-                try:
-                    # Generic way to send, try to match media type
-                    if m.video or (isinstance(f, str) and os.path.splitext(f)[1].lower() in ['.mp4', '.mkv', '.avi']):
-                        sent = await Y.send_video(LOG_GROUP, f, thumb=th, caption=ft,
-                                                duration=dur, height=h, width=w,
-                                                reply_to_message_id=rtmid, progress=prog, progress_args=(c, d, p.id, st))
-                    elif m.audio:
-                        sent = await Y.send_audio(LOG_GROUP, f, thumb=th, caption=ft,
-                                                duration=m.audio.duration, performer=m.audio.performer, title=m.audio.title,
-                                                reply_to_message_id=rtmid, progress=prog, progress_args=(c, d, p.id, st))
-                    elif m.photo:
-                        sent = await Y.send_photo(LOG_GROUP, f, caption=ft,
-                                                reply_to_message_id=rtmid, progress=prog, progress_args=(c, d, p.id, st))
-                    elif m.document:
-                        sent = await Y.send_document(LOG_GROUP, f, thumb=th, caption=ft,
+                    sent = None
+                    try:
+                        # Generic way to send, try to match media type
+                        if is_video:
+                            sent = await Y.send_video(LOG_GROUP, f, thumb=th, caption=ft,
+                                                    duration=dur, height=h, width=w,
                                                     reply_to_message_id=rtmid, progress=prog, progress_args=(c, d, p.id, st))
-                    # Add more specific media types if needed (video_note, voice, sticker)
-                    else:
-                        # Fallback to document if type not explicitly handled
-                        sent = await Y.send_document(LOG_GROUP, f, thumb=th, caption=ft,
+                        elif m.audio:
+                            sent = await Y.send_audio(LOG_GROUP, f, thumb=th, caption=ft,
+                                                    duration=m.audio.duration, performer=m.audio.performer, title=m.audio.title,
+                                                    reply_to_message_id=rtmid, progress=prog, progress_args=(c, d, p.id, st))
+                        elif m.photo:
+                            sent = await Y.send_photo(LOG_GROUP, f, caption=ft,
                                                     reply_to_message_id=rtmid, progress=prog, progress_args=(c, d, p.id, st))
+                        elif m.document:
+                            sent = await Y.send_document(LOG_GROUP, f, thumb=th, caption=ft,
+                                                        reply_to_message_id=rtmid, progress=prog, progress_args=(c, d, p.id, st))
+                        # Add more specific media types if needed (video_note, voice, sticker)
+                        else:
+                            # Fallback to document if type not explicitly handled
+                            sent = await Y.send_document(LOG_GROUP, f, thumb=th, caption=ft,
+                                                        reply_to_message_id=rtmid, progress=prog, progress_args=(c, d, p.id, st))
 
-                    if sent:
-                        await c.copy_message(d, LOG_GROUP, sent.id) # Copy to user's chat from log group
-                        # Ensure 'th' is removed only if it was created during screenshot
-                        if th and os.path.exists(th) and th != f'{d}.jpg': # Check if it's a temp screenshot and not user's custom thumb
-                            os.remove(th)
-                        os.remove(f)
-                        await c.delete_messages(d, p.id)
-                        return 'Done (Large file).'
-                    else:
-                        raise Exception("Failed to send large file via userbot.")
-
-                except Exception as upload_e:
-                    print(f"Large file upload failed for {f}: {upload_e}")
-                    await c.edit_message_text(d, p.id, f'Large file upload failed: {str(upload_e)[:50]}')
-                    if th and os.path.exists(th) and th != f'{d}.jpg':
-                        os.remove(th)
-                    if os.path.exists(f): os.remove(f)
-                    return 'Large file upload failed.'
-
-            # Handling smaller files or if userbot Y is not available
-            await c.edit_message_text(d, p.id, 'Uploading...')
-            st = time.time()
+                        if sent:
+                            await _after_flood(c, c.copy_message, d, LOG_GROUP, sent.id, retry=True) # Copy to user's chat from log group
+                            await _after_flood(c, c.delete_messages, d, p.id)
+                            return 'Done (Large file).'
+                        else:
+                            raise Exception("Failed to send large file via userbot.")
 
-            try:
-                if m.video or (isinstance(f, str) and os.path.splitext(f)[1].lower() in ['.mp4', '.mkv', '.avi']):
-                    mtd = await get_video_metadata(f)
-                    dur, h, w = mtd.get('duration'), mtd.get('height'), mtd.get('width')
-                    th_for_upload = await screenshot(f, dur or 1, d) if not th else th # Use existing thumb or create new
-                    await c.send_video(tcid, video=f, caption=ft, 
-                                    thumb=th_for_upload, width=w, height=h, duration=dur, 
-                                    progress=prog, progress_args=(c, d, p.id, st), 
-                                    reply_to_message_id=rtmid)
-                elif m.video_note:
-                    await c.send_video_note(tcid, video_note=f, progress=prog, 
-                                        progress_args=(c, d, p.id, st), reply_to_message_id=rtmid)
-                elif m.voice:
-                    await c.send_voice(tcid, f, progress=prog, progress_args=(c, d, p.id, st), 
-                                    reply_to_message_id=rtmid)
-                elif m.sticker:
-                    await c.send_sticker(tcid, m.sticker.file_id, reply_to_message_id=rtmid) # Stickers are sent by file_id, not path
-                elif m.audio:
-                    th_for_upload = th # Use existing thumb
-                    await c.send_audio(tcid, audio=f, caption=ft, 
-                                    thumb=th_for_upload, progress=prog, progress_args=(c, d, p.id, st), 
-                                    reply_to_message_id=rtmid)
-                elif m.photo:
-                    th_for_upload = th # Use existing thumb
-                    await c.send_photo(tcid, photo=f, caption=ft, 
-                                    progress=prog, progress_args=(c, d, p.id, st), 
-                                    reply_to_message_id=rtmid)
-                else: # Default to document for other types or fallback
-                    th_for_upload = th # Use existing thumb
-                    await c.send_document(tcid, document=f, caption=ft, 
-                                        progress=prog, progress_args=(c, d, p.id, st), 
-                                        reply_to_message_id=rtmid)
-            except Exception as e:
-                await c.edit_message_text(d, p.id, f'Upload failed: {str(e)[:50]}')
-                # Clean up temp screenshot if created
-                if th and os.path.exists(th) and th != f'{d}.jpg':
-                    os.remove(th)
-                if os.path.exists(f): os.remove(f)
-                return 'Failed.'
+                    except Exception as upload_e:
+                        if isinstance(upload_e, FloodWait): _note_floodwait(Y)
+                        logger.error("Large file upload failed for %s: %s", f, upload_e)
+                        await _after_flood(c, _edit, c, d, p.id, f'Large file upload failed: {str(upload_e)[:50]}')
+                        return 'Large file upload failed.'
+
+                # Handling smaller files or if userbot Y is not available
+                await _after_flood(c, _edit, c, d, p.id, 'Uploading...')
+                st = time.time()
+
+                base_kwargs = {'progress': prog, 'progress_args': (c, d, p.id, st), 'reply_to_message_id': rtmid}
+                try:
+                    if is_video:
+                        mtd = await get_video_metadata(f)
+                        dur, h, w = mtd.get('duration'), mtd.get('height'), mtd.get('width')
+                        th_for_upload = await cached_screenshot(f, dur, d) if not th else th # Use existing thumb or create new
+                        if _is_temp_thumb(th_for_upload): tmp.append(th_for_upload)
+                        async with _limiter(_SEND_LIMITERS, c), _chat_limiter(tcid):
+                            await c.send_video(tcid, video=f, caption=ft, thumb=th_for_upload, width=w, height=h, duration=dur, **base_kwargs)
+                    elif m.sticker:
+                        async with _limiter(_SEND_LIMITERS, c), _chat_limiter(tcid):
+                            await c.send_sticker(tcid, m.sticker.file_id, reply_to_message_id=rtmid) # Stickers are sent by file_id, not path
+                    else:
+                        for attr, method, takes_caption, takes_thumb in _UPLOAD_MAP:
+                            if getattr(m, attr, None):
+                                break
+                        else: # Default to document for other types or fallback
+                            attr, method, takes_caption, takes_thumb = _UPLOAD_DOCUMENT
+                        kw = {attr: f}
+                        if takes_caption: kw['caption'] = ft
+                        if takes_thumb: kw['thumb'] = th # Use existing thumb
+                        async with _limiter(_SEND_LIMITERS, c), _chat_limiter(tcid):
+                            await getattr(c, method)(tcid, **kw, **base_kwargs)
+                except Exception as e:
+                    if isinstance(e, FloodWait): _note_floodwait(c)
+                    await _after_flood(c, _edit, c, d, p.id, f'Upload failed: {str(e)[:50]}')
+                    return 'Failed.'
             
-            # Clean up temp screenshot if created
-            if th and os.path.exists(th) and th != f'{d}.jpg':
-                os.remove(th)
-            os.remove(f)
-            await c.delete_messages(d, p.id)
+                await _after_flood(c, c.delete_messages, d, p.id)
             
-            return 'Done.'
+                return 'Done.'
             
         elif m.text:
             # Ensure m.text.markdown is not None, though generally it shouldn't be for a filters.text message
             if m.text.markdown:
-                await c.send_message(tcid, text=m.text.markdown, reply_to_message_id=rtmid)
+                async with _limiter(_SEND_LIMITERS, c), _chat_limiter(tcid):
+                    await c.send_message(tcid, text=m.text.markdown, reply_to_message_id=rtmid)
                 return 'Sent.'
             else:
                 return 'No text found in message.'
         else: # Handle messages that are neither media nor text
             return 'Unsupported message type.'
+    except FloodWait:
+        # Only reached before anything was delivered; the caller backs off and retries the message
+        if p is not None:
+            await _after_flood(c, c.delete_messages, d, p.id)
+        raise
     except Exception as e:
         # Catch-all for any unhandled errors within process_msg
-        print(f"Error in process_msg for user {d}: {e}")
+        logger.error("Error in process_msg for user %s: %s", d, e, exc_info=True)
         return f'Fatal Error: {str(e)[:50]}'
 
 
+BATCH_PAUSE = 10  # longest rest after a message, right after a FloodWait
+FLOOD_QUIET = 30  # seconds without FloodWait after which workers stop resting
+FLOOD_HALF_LIFE = 5  # seconds for the rest to halve
+
+def _batch_pause(*clients):
+    # Reactive backoff: rest only while a FloodWait is recent, decaying from BATCH_PAUSE
+    last = max((_LAST_FLOODWAIT.get(cl, 0) for cl in clients if cl is not None), default=0)
+    elapsed = time.time() - last
+    if elapsed > FLOOD_QUIET:
+        return 0
+    return BATCH_PAUSE * 0.5 ** (elapsed / FLOOD_HALF_LIFE)
+BATCH_PROGRESS_INTERVAL = 1.0  # seconds between batch status edits
+BATCH_PREFETCH = 2  # fetched messages queued per worker
+BATCH_TEMPLATE = "**Batch Progress:**\nTotal: {t}\nProcessed: {p}\nSuccess: {s}\nStatus: {status}"
+
+async def process_batch(c, u, i, mids, d, lt, uid, pt=None):
+    # Pipeline: one producer prefetches messages ahead of BATCH_WORKERS consumers, so the
+    # get_msg round-trip for the next message overlaps the transfer of the current ones
+    workers = min(BATCH_WORKERS, len(mids))
+    queue = asyncio.Queue(maxsize=workers * BATCH_PREFETCH)
+    lock = asyncio.Lock()
+    state = {'done': 0, 'success': 0, 'status': ''}
+    changed = asyncio.Event()
+    cfg = await get_user_cfg(d)  # chat_id/caption are user-level: resolve once per batch
+    await get_user_rules(d)  # warm the rewrite rules so every caption hits the cache
+
+    shown = None
+
+    async def draw(final=False):
+        nonlocal shown
+        status = state['status'] or ('Finished' if final else 'Running')
+        text = BATCH_TEMPLATE.format(t=len(mids), p=state['done'], s=state['success'], status=status)
+        if text != shown:  # identical edits still cost an RPC (and MESSAGE_NOT_MODIFIED)
+            shown = text
+            try: await pt.edit(text)
+            except FloodWait as e:
+                if not final: await asyncio.sleep(e.value)  # never hold up the batch result
+            except Exception: pass
+
+    async def progress_updater():
+        # Single task renders the batch status, at most once per BATCH_PROGRESS_INTERVAL
+        while True:
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=BATCH_PROGRESS_INTERVAL)
+            except asyncio.TimeoutError:
+                continue
+            changed.clear()
+            await draw()
+            await asyncio.sleep(BATCH_PROGRESS_INTERVAL)
+
+    async def producer():
+        for mid in mids:
+            if should_cancel(uid):
+                break
+            while True:
+                try:
+                    msg = await get_msg(c, u, i, mid, lt)
+                    break
+                except FloodWait as e:
+                    _note_floodwait(u)
+                    await asyncio.sleep(e.value)
+            await queue.put((mid, msg))
+        for _ in range(workers):
+            await queue.put(None)
+
+    async def worker(slot):
+        while True:
+            item = await queue.get()
+            if item is None or should_cancel(uid):
+                return
+            mid, msg = item
+            res = None
+            while msg:
+                try:
+                    res = await process_msg(c, u, msg, d, lt, uid, i, cfg, slot)
+                except FloodWait as e:
+                    # Back off this worker only and retry the message; the others keep going
+                    _note_floodwait(c)
+                    await asyncio.sleep(e.value)
+                    continue
+                except Exception as e:
+                    logger.error("Error processing message %s for %s: %s", mid, uid, e, exc_info=True)
+                    state['status'] = f'{state["done"] + 1}/{len(mids)}: Error - {str(e)[:30]}'
+                break
+            async with lock:
+                state['done'] += 1
+                if res and ('Done' in res or 'Copied' in res or 'Sent' in res):
+                    state['success'] += 1
+                await update_batch_progress(uid, state['done'], state['success'])
+            changed.set()
+            pause = _batch_pause(c, u)
+            if pause:
+                await asyncio.sleep(pause)
+
+    updater = asyncio.create_task(progress_updater()) if pt else None
+    feeder = asyncio.create_task(producer())
+    try:
+        await asyncio.gather(*(worker(f'downloads/{d}/s{k}') for k in range(workers)))
+    finally:
+        feeder.cancel()  # workers may stop early on cancel, leaving it blocked on put()
+        if updater:
+            updater.cancel()
+            with suppress(asyncio.CancelledError):
+                await updater
+            await draw(final=True)  # the updater may have been cancelled before showing the last counts
+    return state['done'], state['success']
+
 @X.on_message(filters.command(['batch', 'single']))
 async def process_cmd(c, m):
     uid = m.from_user.id
     cmd = m.command[0]
     
-    if FREEMIUM_LIMIT == 0 and not await is_premium_user(uid):
+    premium = await is_premium_user(uid) if FREEMIUM_LIMIT == 0 else None
+    if FREEMIUM_LIMIT == 0 and not premium:
         await m.reply_text("This bot does not provide free servies, get subscription from OWNER")
         return
     
@@ -419,9 +975,22 @@ async def process_cmd(c, m):
         await pro.edit('Add your bot with /setbot first')
         return
     
-    Z[uid] = {'step': 'start' if cmd == 'batch' else 'start_single'}
+    # Lookups resolved here are reused for the rest of this command flow (dropped with Z[uid])
+    Z[uid] = {'step': 'start' if cmd == 'batch' else 'start_single', '_ubot': ubot, '_premium': premium}
     await pro.edit(f'Send {"start link..." if cmd == "batch" else "link you to process"}.')
 
+async def _flow_premium(uid):
+    flow = Z[uid]
+    if flow.get('_premium') is None:
+        flow['_premium'] = await is_premium_user(uid)
+    return flow['_premium']
+
+async def _flow_clients(uid):
+    flow = Z[uid]
+    if flow.get('_uc') is None:
+        flow['_uc'] = await get_uclient(uid)
+    return flow.get('_ubot') or UB.get(uid), flow['_uc']
+
 @X.on_message(filters.command(['cancel', 'stop']))
 async def cancel_cmd(c, m):
     uid = m.from_user.id
@@ -438,8 +1007,10 @@ async def cancel_cmd(c, m):
     'pay', 'redeem', 'gencode', 'single', 'generate', 'keyinfo', 'encrypt', 'decrypt', 'keys', 'setbot', 'rembot']))
 async def text_handler(c, m):
     uid = m.from_user.id
-    if uid not in Z: return
-    s = Z[uid].get('step')
+    flow = Z.get(uid)
+    if flow is None: return
+    s = flow.get('step')
+    did = str(m.chat.id)
 
     if s == 'start':
         L = m.text
@@ -448,7 +1019,7 @@ async def text_handler(c, m):
             await m.reply_text('Invalid link format.')
             Z.pop(uid, None)
             return
-        Z[uid].update({'step': 'count', 'cid': i, 'sid': d, 'lt': lt})
+        flow.update({'step': 'count', 'cid': i, 'sid': d, 'lt': lt})
         await m.reply_text('How many messages?')
 
     elif s == 'start_single':
@@ -459,23 +1030,22 @@ async def text_handler(c, m):
             Z.pop(uid, None)
             return
 
-        Z[uid].update({'step': 'process_single', 'cid': i, 'sid': d, 'lt': lt})
-        i, s, lt = Z[uid]['cid'], Z[uid]['sid'], Z[uid]['lt']
+        flow.update({'step': 'process_single', 'cid': i, 'sid': d, 'lt': lt})
+        s = d
         pt = await m.reply_text('Processing...')
         
-        ubot = UB.get(uid)
+        ubot, uc = await _flow_clients(uid)
         if not ubot:
             await pt.edit('Add bot with /setbot first')
             Z.pop(uid, None)
             return
         
-        uc = await get_uclient(uid)
         if not uc:
             await pt.edit('Cannot proceed without user client.')
             Z.pop(uid, None)
             return
             
-        if is_user_active(uid):
+        if not try_reserve_active(uid, {"total": 1, "current": 0, "success": 0, "cancel_requested": False, "progress_message_id": pt.id}):
             await pt.edit('Active task exists. Use /stop first.')
             Z.pop(uid, None)
             return
@@ -483,13 +1053,20 @@ async def text_handler(c, m):
         try:
             msg = await get_msg(ubot, uc, i, s, lt)
             if msg:
-                res = await process_msg(ubot, uc, msg, str(m.chat.id), lt, uid, i)
+                while True:
+                    try:
+                        res = await process_msg(ubot, uc, msg, did, lt, uid, i)
+                        break
+                    except FloodWait as e:
+                        _note_floodwait(ubot)
+                        await asyncio.sleep(e.value)
                 await pt.edit(f'1/1: {res}')
             else:
                 await pt.edit('Message not found')
         except Exception as e:
             await pt.edit(f'Error: {str(e)[:50]}')
         finally:
+            await remove_active_batch(uid)
             Z.pop(uid, None)
 
     elif s == 'count':
@@ -498,64 +1075,40 @@ async def text_handler(c, m):
             return
         
         count = int(m.text)
-        maxlimit = PREMIUM_LIMIT if await is_premium_user(uid) else FREEMIUM_LIMIT
+        maxlimit = PREMIUM_LIMIT if await _flow_premium(uid) else FREEMIUM_LIMIT
 
         if count > maxlimit:
             await m.reply_text(f'Maximum limit is {maxlimit}.')
             return
 
-        Z[uid].update({'step': 'process', 'did': str(m.chat.id), 'num': count})
-        i, s, n, lt = Z[uid]['cid'], Z[uid]['sid'], Z[uid]['num'], Z[uid]['lt']
-        success = 0
+        flow.update({'step': 'process', 'did': did, 'num': count})
+        i, sid, n, lt = flow['cid'], int(flow['sid']), count, flow['lt']
 
         pt = await m.reply_text('Processing batch...')
-        uc = await get_uclient(uid)
-        ubot = UB.get(uid)
+        ubot, uc = await _flow_clients(uid)
         
         if not uc or not ubot:
             await pt.edit('Missing client setup')
             Z.pop(uid, None)
             return
             
-        if is_user_active(uid):
-            await pt.edit('Active task exists')
-            Z.pop(uid, None)
-            return
-        
-        await add_active_batch(uid, {
+        if not try_reserve_active(uid, {
             "total": n,
             "current": 0,
             "success": 0,
             "cancel_requested": False,
             "progress_message_id": pt.id
-            })
+            }):
+            await pt.edit('Active task exists')
+            Z.pop(uid, None)
+            return
         
         try:
-            for j in range(n):
-                
-                if should_cancel(uid):
-                    await pt.edit(f'Cancelled at {j}/{n}. Success: {success}')
-                    break
-                
-                await update_batch_progress(uid, j, success)
-                
-                mid = int(s) + j
-                
-                try:
-                    msg = await get_msg(ubot, uc, i, mid, lt)
-                    if msg:
-                        res = await process_msg(ubot, uc, msg, str(m.chat.id), lt, uid, i)
-                        if 'Done' in res or 'Copied' in res or 'Sent' in res:
-                            success += 1
-                    else:
-                        pass
-                except Exception as e:
-                    try: await pt.edit(f'{j+1}/{n}: Error - {str(e)[:30]}')
-                    except: pass
-                
-                await asyncio.sleep(10)
-            
-            if j+1 == n:
+            mids = range(sid, sid + n)
+            done, success = await process_batch(ubot, uc, i, mids, did, lt, uid, pt)
+            if should_cancel(uid):
+                await pt.edit(f'Cancelled at {done}/{n}. Success: {success}')
+            else:
                 await m.reply_text(f'Batch Completed ✅ Success: {success}/{n}')
         
         finally:
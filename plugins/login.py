@@ -7,7 +7,7 @@ from config import API_HASH, API_ID
 from shared_client import app as bot # Pastikan 'app' dari shared_client adalah instance Client Anda
 from utils.func import save_user_session, get_user_data, remove_user_session, save_user_bot, remove_user_bot
 from utils.encrypt import ecs, dcs
-from plugins.batch import UB, UC
+from plugins.batch import UB, UC, release_ubot
 from utils.custom_filters import login_in_progress, set_user_step, get_user_step
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -86,21 +86,20 @@ async def set_bot_token(C, m):
     args = m.text.split(" ", 1)
     if user_id in UB:
         try:
-            await UB[user_id].stop()
-            if UB.get(user_id, None): # Ensure it exists before deleting
-                del UB[user_id]
+            stopped = await release_ubot(user_id) # Stops the client only if no other user shares its token
             logger.info(f"Stopped and removed old bot for user {user_id}")
         except Exception as e:
+            stopped = None
             logger.error(f"Error stopping old bot for user {user_id}: {e}")
-            if UB.get(user_id, None): # Ensure it exists before deleting
-                del UB[user_id]
 
-        try:
-            if os.path.exists(f"user_{user_id}.session"):
-                os.remove(f"user_{user_id}.session")
-                logger.info(f"Removed user session file for {user_id}")
-        except Exception as e:
-            logger.error(f"Error removing user session file for {user_id}: {e}")
+        # The session file belongs to the token's pooled client: only removed once that was stopped
+        if stopped:
+            try:
+                if os.path.exists(f"{stopped}.session"):
+                    os.remove(f"{stopped}.session")
+                    logger.info(f"Removed bot session file for {user_id}")
+            except Exception as e:
+                logger.error(f"Error removing bot session file for {user_id}: {e}")
 
     if len(args) < 2:
         await m.reply_text("⚠️ Please provide a bot token. Usage: `/setbot token`", quote=True)
@@ -117,21 +116,20 @@ async def rem_bot_token(C, m):
     user_id = m.from_user.id
     if user_id in UB:
         try:
-            await UB[user_id].stop()
-            if UB.get(user_id, None): # Ensure it exists before deleting
-                del UB[user_id]
+            stopped = await release_ubot(user_id) # Stops the client only if no other user shares its token
             logger.info(f"Stopped and removed old bot for user {user_id}")
         except Exception as e:
+            stopped = None
             logger.error(f"Error stopping old bot for user {user_id}: {e}")
-            if UB.get(user_id, None): # Ensure it exists before deleting
-                del UB[user_id]
 
-        try:
-            if os.path.exists(f"user_{user_id}.session"):
-                os.remove(f"user_{user_id}.session")
-                logger.info(f"Removed user session file for {user_id}")
-        except Exception as e:
-            logger.error(f"Error removing user session file for {user_id}: {e}")
+        # The session file belongs to the token's pooled client: only removed once that was stopped
+        if stopped:
+            try:
+                if os.path.exists(f"{stopped}.session"):
+                    os.remove(f"{stopped}.session")
+                    logger.info(f"Removed bot session file for {user_id}")
+            except Exception as e:
+                logger.error(f"Error removing bot session file for {user_id}: {e}")
 
     await remove_user_bot(user_id)
     await m.reply_text("✅ Bot token removed successfully.", quote=True)
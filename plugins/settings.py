@@ -4,9 +4,11 @@ import os
 import asyncio
 import string
 import random
+from dataclasses import dataclass
+from functools import lru_cache
 from shared_client import client as gf
 from config import OWNER_ID
-from utils.func import get_user_data_key, save_user_data, users_collection, get_user_data # Import get_user_data
+from utils.func import get_user_data_key, save_user_data, save_user_data_sync, users_collection, get_user_data, sanitize_filename, add_delete_words # Import get_user_data
 
 VIDEO_EXTENSIONS = {
     'mp4', 'mkv', 'avi', 'mov', 'wmv', 'flv', 'webm',
@@ -15,7 +17,25 @@ VIDEO_EXTENSIONS = {
 SET_PIC = 'settings.jpg'
 MESS = 'Customize settings for your files...'
 
-active_conversations = {}
+@dataclass(slots=True)
+class Conv:
+    type: str
+    message_id: int
+
+active_conversations = {}  # user_id -> Conv
+
+# -100CHANNELID, -100CHANNELID/TOPIC_ID, or a plain user/group id
+_CHAT_RE = re.compile(r'-100\d+(?:/\d+)?|-?\d+')
+# 'WORD(s)' 'REPLACEWORD'
+_REPL_RE = re.compile(r"'(.+)' '(.+)'")
+
+def _safe_unlink(path):
+    # Runs in a worker thread; True when a file was actually removed
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
 
 @gf.on(events.NewMessage(incoming=True, pattern='/settings'))
 async def settings_command(event):
@@ -50,46 +70,27 @@ async def send_settings_message(chat_id, user_id):
     ]
     await gf.send_message(chat_id, MESS, buttons=buttons)
 
+# callback data -> (conversation type, prompt)
+CALLBACK_ACTIONS = {
+    b'setchat': ('setchat', """Send me the ID of that chat(with -100 prefix): 
+__👉 **Note:** if you are using custom bot then your bot should be admin that chat if not then this bot should be admin.__
+👉 __If you want to upload in topic group and in specific topic then pass chat id as **-100CHANNELID/TOPIC_ID** for example: **-1004783898/12**__"""),
+    b'setrename': ('setrename', 'Send me the rename tag:'),
+    b'setcaption': ('setcaption', 'Send me the caption:'),
+    b'setreplacement': ('setreplacement', "Send me the replacement words in the format: 'WORD(s)' 'REPLACEWORD'"),
+    b'addsession': ('addsession', 'Send Pyrogram V2 session string:'),
+    b'delete': ('deleteword', 'Send words separated by space to delete them from caption/filename...'),
+    b'setthumb': ('setthumb', 'Please send the photo you want to set as the thumbnail.'),
+}
+
 @gf.on(events.CallbackQuery)
 async def callback_query_handler(event):
     user_id = event.sender_id
     
-    callback_actions = {
-        b'setchat': {
-            'type': 'setchat',
-            'message': """Send me the ID of that chat(with -100 prefix): 
-__👉 **Note:** if you are using custom bot then your bot should be admin that chat if not then this bot should be admin.__
-👉 __If you want to upload in topic group and in specific topic then pass chat id as **-100CHANNELID/TOPIC_ID** for example: **-1004783898/12**__"""
-        },
-        b'setrename': {
-            'type': 'setrename',
-            'message': 'Send me the rename tag:'
-        },
-        b'setcaption': {
-            'type': 'setcaption',
-            'message': 'Send me the caption:'
-        },
-        b'setreplacement': {
-            'type': 'setreplacement',
-            'message': "Send me the replacement words in the format: 'WORD(s)' 'REPLACEWORD'"
-        },
-        b'addsession': {
-            'type': 'addsession',
-            'message': 'Send Pyrogram V2 session string:'
-        },
-        b'delete': {
-            'type': 'deleteword',
-            'message': 'Send words separated by space to delete them from caption/filename...'
-        },
-        b'setthumb': {
-            'type': 'setthumb',
-            'message': 'Please send the photo you want to set as the thumbnail.'
-        }
-    }
-    
-    if event.data in callback_actions:
-        action = callback_actions[event.data]
-        await start_conversation(event, user_id, action['type'], action['message'])
+    action = CALLBACK_ACTIONS.get(event.data)
+    if action:
+        conv_type, prompt = action
+        await start_conversation(event, user_id, conv_type, prompt)
     elif event.data == b'logout':
         # Perubahan di sini: Tidak ada modified_count di aiosqlite
         # Kita akan mengecek keberadaan sesi sebelum mencoba menghapus
@@ -114,17 +115,14 @@ __👉 **Note:** if you are using custom bot then your bot should be admin that
                     'chat_id': ''
                 }}
             )
-            thumbnail_path = f'{user_id}.jpg'
-            if os.path.exists(thumbnail_path):
-                os.remove(thumbnail_path)
+            await asyncio.to_thread(_safe_unlink, f'{user_id}.jpg')
             await event.respond('✅ All settings reset successfully. To logout, click /logout')
         except Exception as e:
             await event.respond(f'Error resetting settings: {e}')
     elif event.data == b'remthumb':
-        try:
-            os.remove(f'{user_id}.jpg')
+        if await asyncio.to_thread(_safe_unlink, f'{user_id}.jpg'):
             await event.respond('Thumbnail removed successfully!')
-        except FileNotFoundError:
+        else:
             await event.respond('No thumbnail found to remove.')
 
 async def start_conversation(event, user_id, conv_type, prompt_message):
@@ -132,97 +130,116 @@ async def start_conversation(event, user_id, conv_type, prompt_message):
         await event.respond('Previous conversation cancelled. Starting new one.')
     
     msg = await event.respond(f'{prompt_message}\n\n(Send /cancel to cancel this operation)')
-    active_conversations[user_id] = {'type': conv_type, 'message_id': msg.id}
+    active_conversations[user_id] = Conv(conv_type, msg.id)
 
 @gf.on(events.NewMessage(pattern='/cancel'))
 async def cancel_conversation(event):
     user_id = event.sender_id
-    if user_id in active_conversations:
+    if active_conversations.pop(user_id, None) is not None:
         await event.respond('Cancelled enjoy baby...')
-        del active_conversations[user_id]
 
 @gf.on(events.NewMessage())
 async def handle_conversation_input(event):
     user_id = event.sender_id
-    if user_id not in active_conversations or event.message.text.startswith('/'):
+    conv = active_conversations.get(user_id)
+    if conv is None:  # nearly every message: no open settings conversation
+        return
+    text = event.message.text
+    if text and text.startswith('/'):
         return
         
-    conv_type = active_conversations[user_id]['type']
-    
-    handlers = {
-        'setchat': handle_setchat,
-        'setrename': handle_setrename,
-        'setcaption': handle_setcaption,
-        'setreplacement': handle_setreplacement,
-        'addsession': handle_addsession,
-        'deleteword': handle_deleteword,
-        'setthumb': handle_setthumb
-    }
-    
-    if conv_type in handlers:
-        await handlers[conv_type](event, user_id)
+    conv_type = conv.type
     
-    if user_id in active_conversations:
-        del active_conversations[user_id]
+    # Handlers return True once the conversation is finished, False to wait for another reply
+    handler = HANDLERS.get(conv_type)
+    if handler is None or await handler(event, user_id):
+        if active_conversations.get(user_id) is conv:  # a new one may have started meanwhile
+            active_conversations.pop(user_id, None)
 
 async def handle_setchat(event, user_id):
     try:
         chat_id = event.text.strip()
+        if not _CHAT_RE.fullmatch(chat_id):
+            await event.respond('❌ Invalid chat ID. Send it as -100CHANNELID or -100CHANNELID/TOPIC_ID.')
+            return False
         await save_user_data(user_id, 'chat_id', chat_id)
         await event.respond('✅ Chat ID set successfully!')
     except Exception as e:
         await event.respond(f'❌ Error setting chat ID: {e}')
+    return True
 
 async def handle_setrename(event, user_id):
     rename_tag = event.text.strip()
     await save_user_data(user_id, 'rename_tag', rename_tag)
     await event.respond(f'✅ Rename tag set to: {rename_tag}')
+    return True
 
 async def handle_setcaption(event, user_id):
     caption = event.text
     await save_user_data(user_id, 'caption', caption)
     await event.respond(f'✅ Caption set successfully!')
+    return True
 
 async def handle_setreplacement(event, user_id):
-    match = re.match("'(.+)' '(.+)'", event.text)
+    match = _REPL_RE.fullmatch(event.text.strip())
     if not match:
         await event.respond("❌ Invalid format. Usage: 'WORD(s)' 'REPLACEWORD'")
+        return False
     else:
         word, replace_word = match.groups()
         delete_words = await get_user_data_key(user_id, 'delete_words', [])
         if word in delete_words:
             await event.respond(f"❌ The word '{word}' is in the delete list and cannot be replaced.")
         else:
-            replacements = await get_user_data_key(user_id, 'replacement_words', {})
+            replacements = dict(await get_user_data_key(user_id, 'replacement_words', {}))  # cached row is shared
             replacements[word] = replace_word
             await save_user_data(user_id, 'replacement_words', replacements)
             await event.respond(f"✅ Replacement saved: '{word}' will be replaced with '{replace_word}'")
+        return True
 
 async def handle_addsession(event, user_id):
     session_string = event.text.strip()
-    await save_user_data(user_id, 'session_string', session_string)
+    await save_user_data_sync(user_id, 'session_string', session_string)
     await event.respond('✅ Session string added successfully!')
+    return True
 
 async def handle_deleteword(event, user_id):
     words_to_delete = event.message.text.split()
-    delete_words = await get_user_data_key(user_id, 'delete_words', [])
-    delete_words = list(set(delete_words + words_to_delete))
-    await save_user_data(user_id, 'delete_words', delete_words)
+    # Merged, deduplicated and sorted by SQLite in one statement
+    await add_delete_words(user_id, words_to_delete)
     await event.respond(f"✅ Words added to delete list: {', '.join(words_to_delete)}")
+    return True
 
 async def handle_setthumb(event, user_id):
     if event.photo:
-        temp_path = await event.download_media()
+        thumb_path = f'{user_id}.jpg'
         try:
-            thumb_path = f'{user_id}.jpg'
-            if os.path.exists(thumb_path):
-                os.remove(thumb_path)
-            os.rename(temp_path, thumb_path)
+            # Written straight to its final name; an existing thumbnail is overwritten
+            await event.download_media(file=thumb_path)
             await event.respond('✅ Thumbnail saved successfully!')
         except Exception as e:
+            await asyncio.to_thread(_safe_unlink, thumb_path)  # don't keep a partial image
             await event.respond(f'❌ Error saving thumbnail: {e}')
     else:
         await event.respond('❌ Please send a photo. Operation cancelled.')
+    return True
+
+HANDLERS = {
+    'setchat': handle_setchat,
+    'setrename': handle_setrename,
+    'setcaption': handle_setcaption,
+    'setreplacement': handle_setreplacement,
+    'addsession': handle_addsession,
+    'deleteword': handle_deleteword,
+    'setthumb': handle_setthumb
+}
+
+@lru_cache(maxsize=1024)
+def _words_pattern(words):
+    # One alternation for a whole word list, longest first so overlapping words match greedily;
+    # keyed by the words themselves, so editing a list simply produces a new cache entry
+    words = sorted({w for w in words if w}, key=len, reverse=True)
+    return re.compile('|'.join(map(re.escape, words))) if words else None
 
 def generate_random_name(length=7):
     characters = string.ascii_letters + string.digits
@@ -235,32 +252,34 @@ async def rename_file(file, sender, edit):
         custom_rename_tag = await get_user_data_key(sender, 'rename_tag', '')
         replacements = await get_user_data_key(sender, 'replacement_words', {})
         
-        last_dot_index = str(file).rfind('.')
-        if last_dot_index != -1 and last_dot_index != 0:
-            ggn_ext = str(file)[last_dot_index + 1:]
-            if ggn_ext.isalpha() and len(ggn_ext) <= 9:
-                if ggn_ext.lower() in VIDEO_EXTENSIONS:
-                    original_file_name = str(file)[:last_dot_index]
-                    file_extension = 'mp4'
-                else:
-                    original_file_name = str(file)[:last_dot_index]
-                    file_extension = ggn_ext
+        name_str = str(file)
+        head, sep, ggn_ext = name_str.rpartition('.')
+        if sep and head:
+            original_file_name = head
+            # Videos are always re-uploaded as .mp4; other plausible extensions are kept
+            if ggn_ext.isalpha() and len(ggn_ext) <= 9 and ggn_ext.lower() not in VIDEO_EXTENSIONS:
+                file_extension = ggn_ext
             else:
-                original_file_name = str(file)[:last_dot_index]
                 file_extension = 'mp4'
         else:
-            original_file_name = str(file)
+            original_file_name = name_str
             file_extension = 'mp4'
         
-        for word in delete_words:
-            original_file_name = original_file_name.replace(word, '')
+        # Rules and tag are user text: apply them to the file's own name, never the directory part
+        directory, base_name = os.path.split(original_file_name)
+
+        delete_pat = _words_pattern(tuple(delete_words))
+        if delete_pat:
+            base_name = delete_pat.sub('', base_name)
         
-        for word, replace_word in replacements.items():
-            original_file_name = original_file_name.replace(word, replace_word)
+        replace_pat = _words_pattern(tuple(replacements))
+        if replace_pat:
+            base_name = replace_pat.sub(lambda m: replacements[m.group(0)], base_name)
         
-        new_file_name = f'{original_file_name} {custom_rename_tag}.{file_extension}'
+        base_name = sanitize_filename(' '.join(f'{base_name} {custom_rename_tag}'.split()))
+        new_file_name = os.path.join(directory, f'{base_name}.{file_extension}')
         
-        os.rename(file, new_file_name)
+        await asyncio.to_thread(os.replace, file, new_file_name)  # same-directory move: atomic, no byte copy
         return new_file_name
     except Exception as e:
         print(f"Rename error: {e}")
@@ -1,13 +1,28 @@
+import asyncio
 from datetime import timedelta, datetime
 from shared_client import client as bot_client
 from telethon import events
-from utils.func import get_premium_details, is_private_chat, get_display_name, get_user_data, premium_users_collection, is_premium_user, add_premium_user # Import add_premium_user
+from utils.func import get_premium_details, is_private_chat, get_display_name, get_user_data, premium_users_collection, is_premium_user, add_premium_user, get_transfer_state # Import add_premium_user
 from config import OWNER_ID
+from utils.cache import TTLCache
 import logging
 logging.basicConfig(format=
     '%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger('teamspy')
 
+# OWNER_ID is normally a list from config; resolved once instead of per command
+_OWNER_IDS = frozenset([int(OWNER_ID)] if isinstance(OWNER_ID, (int, str)) else map(int, OWNER_ID))
+
+# user_id -> display name, only used to word confirmation messages
+_NAMES = TTLCache(maxsize=1024, ttl=300)
+
+async def cached_name(user_id):
+    name = _NAMES.get(user_id)
+    if name is None:
+        name = get_display_name(await bot_client.get_entity(user_id))
+        _NAMES[user_id] = name
+    return name
+
 
 @bot_client.on(events.NewMessage(pattern='/status'))
 async def status_handler(event):
@@ -55,104 +70,68 @@ async def transfer_premium_handler(event):
     user_id = event.sender_id
     sender = await event.get_sender()
     sender_name = get_display_name(sender)
-    if not await is_premium_user(user_id):
+    args = event.text.split()
+    try:
+        target_user_id = int(args[1]) if len(args) == 2 else None
+    except ValueError:
+        target_user_id = None
+    # Both sides of the transfer in one query
+    now = datetime.now()
+    state = await get_transfer_state(user_id, target_user_id or user_id)
+    expiry_date = state.get(user_id)
+    if not expiry_date or expiry_date <= now:
         await event.respond(
             "❌ You don't have a premium subscription to transfer.")
         return
-    args = event.text.split()
     if len(args) != 2:
         await event.respond(
             'Usage: /transfer user_id\nExample: /transfer 123456789')
         return
-    try:
-        target_user_id = int(args[1])
-    except ValueError:
+    if target_user_id is None:
         await event.respond(
             '❌ Invalid user ID. Please provide a valid numeric user ID.')
         return
     if target_user_id == user_id:
         await event.respond('❌ You cannot transfer premium to yourself.')
         return
-    if await is_premium_user(target_user_id):
+    target_end = state.get(target_user_id)
+    if target_end and target_end > now:
         await event.respond(
             '❌ The target user already has a premium subscription.')
         return
     try:
-        premium_details = await get_premium_details(user_id)
-        if not premium_details:
-            await event.respond('❌ Error retrieving your premium details.')
-            return
         target_name = 'Unknown'
         try:
-            target_entity = await bot_client.get_entity(target_user_id)
-            target_name = get_display_name(target_entity)
+            target_name = await cached_name(target_user_id)
         except Exception as e:
             logger.warning(f'Could not get target user name: {e}')
         
-        # New logic for transfer:
-        # 1. Add premium to target user
-        # 2. Delete premium from original user
-        
-        # When transferring, the duration remains the same, just the start/end dates change relative to now for the new user.
-        # Or, we preserve the exact expiry date. Let's preserve the exact expiry date to be consistent.
-        expiry_date = premium_details['subscription_end']
-        
-        # Use a function that handles adding/updating premium
-        # Since add_premium_user also handles 'upsert' internally, we can reuse it.
-        # We need to calculate duration from current time to expiry_date for add_premium_user
-        time_left = expiry_date - datetime.now()
-        
-        # Convert time_left to a duration value and unit for add_premium_user
-        # This is a bit tricky, let's simplify for now to just pass expiry_date
-        # Or, we create a direct update/insert for premium_users_collection
-        
-        # Direct update/insert for premium_users_collection
-        # We will directly use the update_one with upsert=True logic, but check its success by re-fetching.
-        await premium_users_collection.update_one(
-            {'user_id': target_user_id},
-            {'$set': {
-                'user_id': target_user_id,
-                'subscription_start': datetime.now(), # New start time for the new user
-                'subscription_end': expiry_date, # Preserve original expiry
-                'expireAt': expiry_date, # For TTL index (though SQLite won't use it directly)
-                'transferred_from': user_id,
-                'transferred_from_name': sender_name
-            }},
-            upsert=True
-        )
-        
+        # Preserve the exact expiry; grant and revoke commit together
+        await premium_users_collection.transfer(user_id, target_user_id, expiry_date)
+
         # Verify if the premium was added to the target user
         if not await is_premium_user(target_user_id):
             await event.respond(f'❌ Failed to transfer premium to {target_name}.')
             return
-        
-        # Delete premium from the original user
-        await premium_users_collection.delete_one({'user_id': user_id})
-
-        # Verify if the premium was removed from the original user
-        if await is_premium_user(user_id):
-            await event.respond(f'❌ Failed to remove premium from original user {sender_name} during transfer.')
-            return
             
         expiry_ist = expiry_date + timedelta(hours=5, minutes=30)
         formatted_expiry = expiry_ist.strftime('%d-%b-%Y %I:%M:%S %p')
         await event.respond(
             f'✅ Premium subscription successfully transferred to {target_name} ({target_user_id}). Your premium access has been removed.'
             )
-        try:
-            await bot_client.send_message(target_user_id,
+        owner_msg = f'♻️ Premium Transfer: {sender_name} ({user_id}) has transferred their premium to {target_name} ({target_user_id}). Expiry: {formatted_expiry}'
+        # Independent notifications: send together, one failure doesn't cancel the others
+        target_res, *owner_res = await asyncio.gather(
+            bot_client.send_message(target_user_id,
                 f'🎁 You have received a premium subscription transfer from {sender_name} ({user_id}). Your premium is valid until {formatted_expiry} (IST).'
-                )
-        except Exception as e:
-            logger.error(f'Could not notify target user {target_user_id}: {e}')
-        try:
-            owner_id = int(OWNER_ID) if isinstance(OWNER_ID, str
-                ) else OWNER_ID[0] if isinstance(OWNER_ID, list) else OWNER_ID
-            await bot_client.send_message(owner_id,
-                f'♻️ Premium Transfer: {sender_name} ({user_id}) has transferred their premium to {target_name} ({target_user_id}). Expiry: {formatted_expiry}'
-                )
-        except Exception as e:
-            logger.error(f'Could not notify owner about premium transfer: {e}')
+                ),
+            *(bot_client.send_message(owner_id, owner_msg) for owner_id in _OWNER_IDS),
+            return_exceptions=True)
+        if isinstance(target_res, Exception):
+            logger.error(f'Could not notify target user {target_user_id}: {target_res}')
+        for res in owner_res:
+            if isinstance(res, Exception):
+                logger.error(f'Could not notify owner about premium transfer: {res}')
         return
     except Exception as e:
         logger.error(
@@ -166,7 +145,7 @@ async def remove_premium_handler(event):
     user_id = event.sender_id
     if not await is_private_chat(event):
         return
-    if user_id not in OWNER_ID:
+    if user_id not in _OWNER_IDS:
         return
     args = event.text.split()
     if len(args) != 2:
@@ -185,8 +164,7 @@ async def remove_premium_handler(event):
     try:
         target_name = 'Unknown'
         try:
-            target_entity = await bot_client.get_entity(target_user_id)
-            target_name = get_display_name(target_entity)
+            target_name = await cached_name(target_user_id)
         except Exception as e:
             logger.warning(f'Could not get target user name: {e}')
         
@@ -5,8 +5,11 @@
 from telethon import TelegramClient
 from config import API_ID, API_HASH, BOT_TOKEN, STRING
 from pyrogram import Client
+import logging
 import sys
 
+logger = logging.getLogger(__name__)
+
 client = TelegramClient("telethonbot", API_ID, API_HASH)
 app = Client("pyrogrambot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
 userbot = Client("4gbbot", api_id=API_ID, api_hash=API_HASH, session_string=STRING)
@@ -14,15 +17,16 @@ userbot = Client("4gbbot", api_id=API_ID, api_hash=API_HASH, session_string=STRI
 async def start_client():
     if not client.is_connected():
         await client.start(bot_token=BOT_TOKEN)
-        print("SpyLib started...")
-    if STRING:
+        logger.info("SpyLib started...")
+    if STRING and not userbot.is_connected:
         try:
             await userbot.start()
-            print("Userbot started...")
+            logger.info("Userbot started...")
         except Exception as e:
-            print(f"Hey honey!! check your premium string session, it may be invalid of expire {e}")
+            logger.error("Hey honey!! check your premium string session, it may be invalid of expire %s", e)
             sys.exit(1)
-    await app.start()
-    print("Pyro App Started...")
+    if not app.is_connected:
+        await app.start()
+        logger.info("Pyro App Started...")
     return client, app, userbot
 
@@ -0,0 +1,125 @@
+# Copyright (c) 2025 devgagan : https://github.com/devgaganin.  
+# Licensed under the GNU General Public License v3.0.  
+# See LICENSE file in the repository root for full license text.
+
+import time
+import asyncio
+from collections import OrderedDict
+
+class TTLCache:
+    # Bounded LRU mapping whose entries expire after `ttl` seconds without access.
+    # on_evict(key, value) runs for expired/LRU-dropped entries, never for explicit deletes.
+    # Keys for which pinned(key) is true are never evicted: they get a fresh ttl instead,
+    # and may hold the cache above maxsize until they are unpinned.
+    def __init__(self, maxsize, ttl, on_evict=None, pinned=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.pinned = pinned
+        self._data = OrderedDict()  # key -> (expires_at, value), oldest access first
+
+    def _is_pinned(self, key):
+        return self.pinned is not None and self.pinned(key)
+
+    def _expire(self):
+        now = time.monotonic()
+        data = self._data
+        evicted = []
+        kept = []
+        while data:
+            key, (exp, value) = next(iter(data.items()))
+            if exp > now:
+                break
+            del data[key]
+            (kept if self._is_pinned(key) else evicted).append((key, value))
+        for key, value in kept:
+            data[key] = (now + self.ttl, value)
+        self._notify(evicted)
+
+    def _notify(self, evicted):
+        if self.on_evict:
+            for key, value in evicted:
+                self.on_evict(key, value)
+
+    def get(self, key, default=None):
+        self._expire()
+        item = self._data.get(key)
+        if item is None:
+            return default
+        self._data[key] = (time.monotonic() + self.ttl, item[1])
+        self._data.move_to_end(key)
+        return item[1]
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._expire()
+        data = self._data
+        data[key] = (time.monotonic() + self.ttl, value)
+        data.move_to_end(key)
+        excess = len(data) - self.maxsize
+        if excess > 0:
+            # Oldest unpinned entries go first; the entry just stored is never the victim
+            victims = []
+            for old_key in data:
+                if len(victims) == excess or old_key == key:
+                    break
+                if not self._is_pinned(old_key):
+                    victims.append(old_key)
+            self._notify([(k, data.pop(k)[1]) for k in victims])
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def __contains__(self, key):
+        self._expire()
+        return key in self._data
+
+    def __len__(self):
+        self._expire()
+        return len(self._data)
+
+    def values(self):
+        self._expire()
+        return [value for _, value in self._data.values()]
+
+
+# Per-user read-through cache: user_id -> {fetcher name: (expires_at, value)}
+USER_CACHE_SIZE = 10_000
+_users = {}
+_user_locks = {}
+_user_gen = {}  # bumped by invalidate() so a fetch that raced a write is not stored
+
+async def cached_user(user_id, fetcher, ttl=30):
+    name = fetcher.__qualname__
+    entry = _users.get(user_id, {}).get(name)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    # One fetch per key on a miss; concurrent callers wait for it instead of querying too
+    lock = _user_locks.setdefault((user_id, name), asyncio.Lock())
+    async with lock:
+        entry = _users.get(user_id, {}).get(name)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        gen = _user_gen.get(user_id, 0)
+        try:
+            value = await fetcher(user_id)
+        finally:
+            _user_locks.pop((user_id, name), None)
+        if _user_gen.get(user_id, 0) == gen:
+            if user_id not in _users and len(_users) >= USER_CACHE_SIZE:
+                _users.pop(next(iter(_users)))
+            _users.setdefault(user_id, {})[name] = (time.monotonic() + ttl, value)
+        return value
+
+def invalidate(user_id):
+    _users.pop(user_id, None)
+    _user_gen[user_id] = _user_gen.get(user_id, 0) + 1
@@ -1,32 +1,58 @@
-import concurrent.futures
 import time
 import os
 import re
-import cv2
+import uuid
 import logging
 import asyncio
 import aiosqlite
+import contextvars
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
-import json # <--- ADD THIS IMPORT for json.dumps and json.loads
+from functools import lru_cache
+import orjson
+from utils.cache import TTLCache, cached_user, invalidate
+
+try:
+    import av  # optional: in-process demuxer, avoids spawning ffprobe
+except ImportError:
+    av = None
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 PUBLIC_LINK_PATTERN = re.compile(r'(https?://)?(t\.me|telegram\.me)/([^/]+)(/(\d+))?')
 PRIVATE_LINK_PATTERN = re.compile(r'(https?://)?(t\.me|telegram\.me)/c/(\d+)(/(\d+))?')
+E_PRIVATE_PATTERN = re.compile(r'https://t\.me/c/(\d+)/(?:\d+/)?(\d+)')
+E_PUBLIC_PATTERN = re.compile(r'https://t\.me/([^/]+)/(?:\d+/)?(\d+)')
 VIDEO_EXTENSIONS = {"mp4", "mkv", "avi", "mov", "wmv", "flv", "webm", "mpeg", "mpg", "3gp"}
 
 DB_PATH = 'data.db'
+DB_CACHED_STATEMENTS = 256
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA mmap_size=268435456",  # 256 MiB: reads served from the page cache without read() copies
+    "PRAGMA busy_timeout=5000",  # wait for a competing writer instead of failing with "database is locked"
+)
+
+# Set while the current task is inside DatabaseManager.transaction()
+_IN_TX = contextvars.ContextVar("db_in_tx", default=False)
 
 class DatabaseManager:
     def __init__(self, db_path):
         self.db_path = db_path
         self._conn = None
+        self._tx_lock = asyncio.Lock()  # one writer transaction at a time on the shared connection
 
     async def connect(self):
         if self._conn is None:
-            self._conn = await aiosqlite.connect(self.db_path)
+            # sqlite3 keeps prepared statements per SQL string; room for every distinct query here
+            self._conn = await aiosqlite.connect(self.db_path, cached_statements=DB_CACHED_STATEMENTS)
             self._conn.row_factory = aiosqlite.Row
+            for pragma in DB_PRAGMAS:
+                await self._conn.execute(pragma)
 
             await self._create_tables()
 
@@ -36,24 +62,67 @@ class DatabaseManager:
             self._conn = None
 
     async def _execute(self, query, params=()):
+        # No commit: reads, or writes issued inside transaction()
         await self.connect()
         try:
-            cursor = await self._conn.execute(query, params)
-            await self._conn.commit()
-            return cursor
+            return await self._conn.execute(query, params)
         except Exception as e:
             logger.error(f"Error executing query: {query} with params {params} - {e}")
             raise
 
+    async def _execute_commit(self, query, params=()):
+        # A single write as its own transaction (joins the caller's one if already inside)
+        async with self.transaction():
+            return await self._execute(query, params)
+
+    @asynccontextmanager
+    async def transaction(self):
+        # BEGIN IMMEDIATE ... COMMIT around the block, ROLLBACK if it raises. Writers are
+        # serialized so another task's commit can never land in the middle of this one.
+        if _IN_TX.get():
+            yield
+            return
+        await self.connect()
+        async with self._tx_lock:
+            token = _IN_TX.set(True)
+            try:
+                await self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    yield
+                except BaseException:
+                    await self._conn.rollback()
+                    raise
+                await self._conn.commit()
+            finally:
+                _IN_TX.reset(token)
+
+    async def _execute_atomic(self, statements):
+        # Several writes committed together: either all of them land or none do
+        async with self.transaction():
+            for query, params in statements:
+                await self._execute(query, params)
+
     async def _fetchone(self, query, params=()):
+        # Reads never commit; the cursor is closed as soon as the row is out
         cursor = await self._execute(query, params)
-        return await cursor.fetchone()
+        async with cursor:
+            return await cursor.fetchone()
 
     async def _fetchall(self, query, params=()):
-        cursor = await self._execute(query, params)
-        return await cursor.fetchall()
+        # execute + fetchall in one hop to the connection thread instead of two
+        await self.connect()
+        try:
+            return await self._conn.execute_fetchall(query, params)
+        except Exception as e:
+            logger.error(f"Error executing query: {query} with params {params} - {e}")
+            raise
 
     async def _create_tables(self):
+        async with self.transaction():
+            await self._create_tables_tx()
+        logger.info("Database tables initialized.")
+
+    async def _create_tables_tx(self):
         await self._execute('''
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
@@ -92,7 +161,27 @@ class DatabaseManager:
                 used_at DATETIME
             )
         ''')
-        logger.info("Database tables initialized.")
+        await self._migrate_premium_times()
+        # statistics is filtered by event_type and/or user_id and ordered by timestamp
+        await self._execute("CREATE INDEX IF NOT EXISTS idx_stats_event_user ON statistics(event_type, user_id)")
+        await self._execute("CREATE INDEX IF NOT EXISTS idx_stats_user ON statistics(user_id)")
+        await self._execute("CREATE INDEX IF NOT EXISTS idx_stats_ts ON statistics(timestamp)")
+        await self._execute("CREATE INDEX IF NOT EXISTS idx_premium_end ON premium_users(subscription_end)")
+        await self._execute("CREATE INDEX IF NOT EXISTS idx_redeem_used_by ON redeem_code(used_by)")
+
+    async def _migrate_premium_times(self):
+        # One-time rewrite of ISO-string premium times (older rows) into unix seconds
+        rows = await self._fetchall(
+            "SELECT user_id, subscription_start, subscription_end FROM premium_users "
+            "WHERE typeof(subscription_start) = 'text' OR typeof(subscription_end) = 'text'"
+        )
+        for user_id, start, end in rows:
+            await self._execute(
+                "UPDATE premium_users SET subscription_start = ?, subscription_end = ? WHERE user_id = ?",
+                (_iso_to_epoch(start), _iso_to_epoch(end), user_id)
+            )
+        if rows:
+            logger.info(f"Converted {len(rows)} premium rows to unix timestamps.")
 
     async def get_users_collection(self):
         return UsersCollection(self)
@@ -108,9 +197,112 @@ class DatabaseManager:
 
 db_manager = DatabaseManager(DB_PATH)
 
+# users rows parsed by find_one stay this long without access; every users write drops them
+USER_ROW_TTL = 300
+# save_user_data calls arriving within this window (up to this many) share one transaction
+USER_WRITE_WINDOW = 0.05
+USER_WRITE_BATCH = 100
+_MISSING = object()
+# user_id -> (replacement pattern, replacement map, delete word set) derived from that row
+_RULES = TTLCache(maxsize=10_000, ttl=60)
+
+# Merges a JSON array of words into users.delete_words inside SQLite (JSON1), deduplicated and sorted
+ADD_DELETE_WORDS_SQL = """
+    INSERT INTO users (user_id, delete_words, updated_at)
+    VALUES (?, (SELECT json_group_array(value) FROM (SELECT DISTINCT value FROM json_each(?) ORDER BY value)), ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        delete_words = (SELECT json_group_array(value) FROM (
+            SELECT value FROM json_each(COALESCE(users.delete_words, '[]'))
+            UNION SELECT value FROM json_each(excluded.delete_words)
+            ORDER BY value)),
+        updated_at = excluded.updated_at
+"""
+
+# update_one SQL, built once per (table, set columns, unset columns) shape; table and column
+# names always come from this module, values are bound as parameters
+@lru_cache(maxsize=64)
+def _upsert_sql(table, columns, unset=()):
+    marks = ", ".join("?" * len(columns))
+    updates = ", ".join([f"{c} = excluded.{c}" for c in columns] + [f"{c} = NULL" for c in unset])
+    return (f"INSERT INTO {table} (user_id, {', '.join(columns)}) VALUES (?, {marks}) "
+            f"ON CONFLICT(user_id) DO UPDATE SET {updates}")
+
+
+@lru_cache(maxsize=64)
+def _update_sql(table, columns, unset=()):
+    updates = ", ".join([f"{c} = ?" for c in columns] + [f"{c} = NULL" for c in unset])
+    return f"UPDATE {table} SET {updates} WHERE user_id = ?"
+
 class UsersCollection:
     def __init__(self, db_manager):
         self.db_manager = db_manager
+        # user_id -> row with its word lists already decoded (None for unknown users)
+        self._user_cache = TTLCache(maxsize=10_000, ttl=USER_ROW_TTL)
+        self._writes = 0  # bumped by every write so a load that raced one is not cached
+        self._write_queue = asyncio.Queue()  # (user_id, key, value, future) for the coalescing writer
+        self._writer_task = None
+
+    def _forget(self, user_id):
+        self._writes += 1
+        self._user_cache.pop(user_id)
+        _RULES.pop(user_id)
+        invalidate(user_id)
+
+    async def queue_set(self, user_id, key, value):
+        # Resolves once the write is committed, so callers still read their own writes
+        fut = asyncio.get_running_loop().create_future()
+        await self._write_queue.put((user_id, key, value, fut))
+        if self._writer_task is None or self._writer_task.done():
+            self._writer_task = asyncio.get_running_loop().create_task(self._write_loop())
+        return await fut
+
+    async def _write_loop(self):
+        loop = asyncio.get_running_loop()
+        queue = self._write_queue
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + USER_WRITE_WINDOW
+            while len(batch) < USER_WRITE_BATCH:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            done = []
+            try:
+                async with self.db_manager.transaction():
+                    for item in batch:
+                        user_id, key, value, fut = item
+                        # Each write in its own savepoint: a bad one is undone alone, not the batch
+                        await self.db_manager._execute("SAVEPOINT user_write")
+                        try:
+                            await self.update_one({"user_id": user_id}, {"$set": {key: value}}, upsert=True)
+                        except Exception as e:
+                            await self.db_manager._execute("ROLLBACK TO user_write")
+                            await self.db_manager._execute("RELEASE user_write")
+                            self._forget(int(user_id))
+                            if not fut.done():
+                                fut.set_exception(e)
+                            continue
+                        await self.db_manager._execute("RELEASE user_write")
+                        done.append(item)
+            except Exception as e:
+                # The transaction itself failed: rows cached from the uncommitted writes must go too
+                for user_id, _, _, fut in batch:
+                    self._forget(int(user_id))
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            for *_, fut in done:
+                if not fut.done():
+                    fut.set_result(None)
+
+    async def add_delete_words(self, user_id, words):
+        user_id = int(user_id)
+        await self.db_manager._execute_commit(ADD_DELETE_WORDS_SQL, (user_id, orjson.dumps(list(words)).decode(), datetime.now().isoformat()))
+        self._forget(user_id)
 
     async def update_one(self, filter_query, update_query, upsert=False):
         user_id = filter_query.get("user_id")
@@ -122,81 +314,72 @@ class UsersCollection:
         
         # Convert dict/list to JSON string for storage
         if "replacement_words" in set_fields and isinstance(set_fields["replacement_words"], dict):
-            set_fields["replacement_words"] = json.dumps(set_fields["replacement_words"])
+            set_fields["replacement_words"] = orjson.dumps(set_fields["replacement_words"]).decode()
         if "delete_words" in set_fields and isinstance(set_fields["delete_words"], list):
-            set_fields["delete_words"] = json.dumps(set_fields["delete_words"])
+            set_fields["delete_words"] = orjson.dumps(set_fields["delete_words"]).decode()
 
         # Add updated_at for all updates
         set_fields["updated_at"] = datetime.now().isoformat()
 
-        # Build SET clause
-        set_clauses = [f"{k} = ?" for k in set_fields]
-        set_values = list(set_fields.values())
-
-        # Build UNSET (set to NULL) clause
-        unset_clauses = [f"{k} = NULL" for k in unset_fields]
-
-        if set_clauses or unset_clauses:
-            update_parts = []
-            if set_clauses:
-                update_parts.append(", ".join(set_clauses))
-            if unset_clauses:
-                update_parts.append(", ".join(unset_clauses))
-            
-            update_sql = "SET " + ", ".join(update_parts)
-            
-            existing_user = await self.db_manager._fetchone("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
-            
-            if existing_user:
-                query = f"UPDATE users {update_sql} WHERE user_id = ?"
-                values = set_values + [user_id]
-                await self.db_manager._execute(query, values)
-            elif upsert:
-                # For upsert, we need to construct an INSERT statement
-                columns_to_insert = ["user_id"]
-                placeholders_to_insert = ["?"]
-                values_to_insert = [user_id]
-
-                for k, v in set_fields.items():
-                    columns_to_insert.append(k)
-                    placeholders_to_insert.append("?")
-                    values_to_insert.append(v)
-                
-                # For unset fields in an upsert, they should either be explicitly added as NULL
-                # or assumed to be NULL by default in new rows if not set.
-                # Since we are using INSERT OR REPLACE, any existing unset fields would be preserved as NULL
-                # if not explicitly included in the SET part of the upsert.
-                # If you need to ensure they are NULL on initial insert, you'd add them here.
-                # For simplicity, we'll assume new records get default NULL for missing fields.
-
-                insert_sql = f"INSERT OR REPLACE INTO users ({', '.join(columns_to_insert)}) VALUES ({', '.join(placeholders_to_insert)})"
-                await self.db_manager._execute(insert_sql, values_to_insert)
-            else:
-                logger.warning(f"User {user_id} not found and upsert is false.")
+        # One statement either way: no existence check, and an upsert never drops untouched columns
+        columns = tuple(k for k in set_fields if k != "user_id")
+        unset = tuple(k for k in unset_fields if k not in set_fields)
+        values = [set_fields[k] for k in columns]
+        if upsert:
+            await self.db_manager._execute_commit(_upsert_sql("users", columns, unset), [user_id, *values])
         else:
-            logger.debug(f"No fields to update for user {user_id}.")
+            cursor = await self.db_manager._execute_commit(_update_sql("users", columns, unset), [*values, user_id])
+            if cursor.rowcount == 0:
+                logger.warning(f"User {user_id} not found and upsert is false.")
+                return
+        self._forget(int(user_id))
 
     async def find_one(self, filter_query):
         user_id = filter_query.get("user_id")
         if not user_id:
             return None
-        
+
+        user_id = int(user_id)
+        data = self._user_cache.get(user_id, _MISSING)
+        if data is _MISSING:
+            writes = self._writes
+            data = await self._load(user_id)
+            if writes == self._writes:
+                self._user_cache[user_id] = data
+        return data
+
+    async def _load(self, user_id):
         row = await self.db_manager._fetchone("SELECT * FROM users WHERE user_id = ?", (user_id,))
         if row:
             data = dict(row)
             # Convert JSON string back to dict/list
             if 'replacement_words' in data and data['replacement_words']:
-                data['replacement_words'] = json.loads(data['replacement_words'])
+                data['replacement_words'] = orjson.loads(data['replacement_words'])
             else:
                 data['replacement_words'] = {}
             if 'delete_words' in data and data['delete_words']:
-                data['delete_words'] = json.loads(data['delete_words'])
+                data['delete_words'] = orjson.loads(data['delete_words'])
             else:
                 data['delete_words'] = []
             return data
         return None
 
 
+def _iso_to_epoch(value):
+    # Naive ISO strings were written with datetime.now(), i.e. local time, like fromisoformat reads them
+    if isinstance(value, str):
+        return int(datetime.fromisoformat(value).timestamp())
+    return value
+
+
+def _to_datetime(value):
+    # premium times are stored as unix seconds; datetimes are only built for display
+    return datetime.fromtimestamp(value) if value is not None else None
+
+
+PREMIUM_PUT_SQL = "INSERT OR REPLACE INTO premium_users (user_id, subscription_start, subscription_end) VALUES (?, ?, ?)"
+PREMIUM_DELETE_SQL = "DELETE FROM premium_users WHERE user_id = ?"
+
 class PremiumUsersCollection:
     def __init__(self, db_manager):
         self.db_manager = db_manager
@@ -207,43 +390,43 @@ class PremiumUsersCollection:
             raise ValueError("user_id is required for update_one in premium_users collection.")
 
         set_fields = update_query.get("$set", {})
-        
-        set_clauses = [f"{k} = ?" for k in set_fields]
-        set_values = list(set_fields.values())
+        columns = tuple(k for k in set_fields if k != "user_id")
+        if not columns:
+            return
+        values = [set_fields[k] for k in columns]
 
-        existing_user = await self.db_manager._fetchone("SELECT 1 FROM premium_users WHERE user_id = ?", (user_id,))
-        
-        if existing_user:
-            query = f"UPDATE premium_users SET {', '.join(set_clauses)} WHERE user_id = ?"
-            await self.db_manager._execute(query, set_values + [user_id])
-        elif upsert:
-            columns = []
-            placeholders = []
-            insert_values = []
-            
-            columns.append("user_id")
-            placeholders.append("?")
-            insert_values.append(user_id)
-
-            for k, v in set_fields.items():
-                columns.append(k)
-                placeholders.append("?")
-                insert_values.append(v)
-            
-            insert_sql = f"INSERT INTO premium_users ({', '.join(columns)}) VALUES ({', '.join(placeholders)})"
-            await self.db_manager._execute(insert_sql, insert_values)
+        if upsert:
+            await self.db_manager._execute_commit(_upsert_sql("premium_users", columns), [user_id, *values])
         else:
-            logger.warning(f"Premium user {user_id} not found and upsert is false.")
+            cursor = await self.db_manager._execute_commit(_update_sql("premium_users", columns), [*values, user_id])
+            if cursor.rowcount == 0:
+                logger.warning(f"Premium user {user_id} not found and upsert is false.")
+                return
+        invalidate(int(user_id))
+
+    async def delete_one(self, filter_query):
+        user_id = filter_query.get("user_id")
+        if not user_id:
+            raise ValueError("user_id is required for delete_one in premium_users collection.")
+        await self.db_manager._execute_commit(PREMIUM_DELETE_SQL, (user_id,))
+        invalidate(int(user_id))
+
+    async def transfer(self, from_user_id, to_user_id, subscription_end):
+        # Grant to the target and revoke from the source in one transaction
+        await self.db_manager._execute_atomic((
+            (PREMIUM_PUT_SQL, (to_user_id, int(time.time()), int(subscription_end.timestamp()))),
+            (PREMIUM_DELETE_SQL, (from_user_id,)),
+        ))
+        invalidate(int(from_user_id))
+        invalidate(int(to_user_id))
 
     async def find_one(self, filter_query):
         user_id = filter_query.get("user_id")
         if not user_id:
             return None
         
-        row = await self.db_manager._fetchone("SELECT * FROM premium_users WHERE user_id = ?", (user_id,))
-        if row:
-            return dict(row)
-        return None
+        # aiosqlite.Row already reads by column name; no per-row dict copy
+        return await self.db_manager._fetchone("SELECT * FROM premium_users WHERE user_id = ?", (user_id,))
 
     async def create_index(self, field_name, expireAfterSeconds=None):
         logger.info(f"SQLite does not support TTL indexes like MongoDB. "
@@ -258,7 +441,7 @@ class StatisticsCollection:
         self.db_manager = db_manager
 
     async def insert_one(self, document):
-        await self.db_manager._execute(
+        await self.db_manager._execute_commit(
             "INSERT INTO statistics (event_type, timestamp, user_id) VALUES (?, ?, ?)",
             (document.get('event_type'), document.get('timestamp'), document.get('user_id'))
         )
@@ -309,8 +492,7 @@ class StatisticsCollection:
             limit_sql = f"LIMIT {limit}"
 
         query = f"SELECT * FROM statistics {where_sql} {order_by_sql} {limit_sql}"
-        rows = await self.db_manager._fetchall(query, tuple(params))
-        return [dict(row) for row in rows] if rows else []
+        return await self.db_manager._fetchall(query, tuple(params))
 
 
 class RedeemCodeCollection:
@@ -321,13 +503,10 @@ class RedeemCodeCollection:
         code = filter_query.get("code")
         if not code:
             return None
-        row = await self.db_manager._fetchone("SELECT * FROM redeem_code WHERE code = ?", (code,))
-        if row:
-            return dict(row)
-        return None
+        return await self.db_manager._fetchone("SELECT * FROM redeem_code WHERE code = ?", (code,))
 
     async def insert_one(self, document):
-        await self.db_manager._execute(
+        await self.db_manager._execute_commit(
             "INSERT INTO redeem_code (code, duration_value, duration_unit, used_by, used_at) VALUES (?, ?, ?, ?, ?)",
             (document.get('code'), document.get('duration_value'), document.get('duration_unit'), 
              document.get('used_by'), document.get('used_at'))
@@ -344,13 +523,13 @@ class RedeemCodeCollection:
         set_values = list(set_fields.values())
 
         query = f"UPDATE redeem_code SET {', '.join(set_clauses)} WHERE code = ?"
-        await self.db_manager._execute(query, set_values + [code])
+        await self.db_manager._execute_commit(query, set_values + [code])
 
     async def delete_one(self, filter_query):
         code = filter_query.get("code")
         if not code:
             raise ValueError("code is required for delete_one in redeem_code collection.")
-        await self.db_manager._execute("DELETE FROM redeem_code WHERE code = ?", (code,))
+        await self.db_manager._execute_commit("DELETE FROM redeem_code WHERE code = ?", (code,))
 
 users_collection = None
 premium_users_collection = None
@@ -395,14 +574,15 @@ def hhmmss(seconds):
     return time.strftime('%H:%M:%S', time.gmtime(seconds))
 
 
+@lru_cache(maxsize=1024)
 def E(L):
-    private_match = re.match(r'https://t\.me/c/(\d+)/(?:\d+/)?(\d+)', L)
-    public_match = re.match(r'https://t\.me/([^/]+)/(?:\d+/)?(\d+)', L)
-
-    if private_match:
-        return f'-100{private_match.group(1)}', int(private_match.group(2)), 'private'
-    elif public_match:
-        return public_match.group(1), int(public_match.group(2)), 'public'
+    # The public pattern also matches /c/ links, so private is tried first and only it on a hit
+    m = E_PRIVATE_PATTERN.match(L)
+    if m:
+        return f'-100{m.group(1)}', int(m.group(2)), 'private'
+    m = E_PUBLIC_PATTERN.match(L)
+    if m:
+        return m.group(1), int(m.group(2)), 'public'
 
     return None, None, None
 
@@ -420,8 +600,10 @@ def get_display_name(user):
         return "Unknown User"
 
 
+_SANITIZE_TABLE = str.maketrans(dict.fromkeys('<>:"/\\|?*', '_'))
+
 def sanitize_filename(filename):
-    return re.sub(r'[<>:"/\\|?*]', '_', filename)
+    return filename.translate(_SANITIZE_TABLE)
 
 
 def get_dummy_filename(info):
@@ -440,7 +622,16 @@ async def is_private_chat(event):
     return event.is_private
 
 
+async def add_delete_words(user_id, words):
+    await users_collection.add_delete_words(user_id, words)
+
+
 async def save_user_data(user_id, key, value):
+    await users_collection.queue_set(user_id, key, value)
+
+
+async def save_user_data_sync(user_id, key, value):
+    # Bypasses the write queue: committed on its own before this returns
     await users_collection.update_one(
         {"user_id": user_id},
         {"$set": {key: value}},
@@ -448,8 +639,16 @@ async def save_user_data(user_id, key, value):
     )
 
 
+# Expiries are minutes to years away; every premium write through this module invalidates anyway
+PREMIUM_TTL = 60
+
+
+async def _find_premium(user_id):
+    return await premium_users_collection.find_one({"user_id": user_id})
+
+
 async def get_user_data_key(user_id, key, default=None):
-    user_data = await users_collection.find_one({"user_id": int(user_id)})
+    user_data = await users_collection.find_one({"user_id": user_id})
     return user_data.get(key, default) if user_data else default
 
 
@@ -462,6 +661,11 @@ async def get_user_data(user_id):
         return None
 
 
+async def get_user_cfg(user_id):
+    # One users lookup shared by every setting read during a batch
+    return await users_collection.find_one({"user_id": user_id}) or {}
+
+
 async def save_user_session(user_id, session_string):
     try:
         await users_collection.update_one(
@@ -522,17 +726,37 @@ async def remove_user_bot(user_id):
         return False
 
 
+def _replacement_pattern(replacements):
+    # One alternation over every word, longest first so a word never loses to its own prefix
+    words = [w for w in replacements if w]
+    if not words:
+        return None
+    return re.compile("|".join(map(re.escape, sorted(words, key=len, reverse=True))))
+
+
+async def get_user_rules(user_id):
+    # Rewrite rules prepared once and shared by every message of a batch
+    user_id = int(user_id)
+    rules = _RULES.get(user_id)
+    if rules is None:
+        cfg = await get_user_cfg(user_id)
+        replacements = dict(cfg.get("replacement_words") or {})
+        rules = (_replacement_pattern(replacements), replacements, frozenset(cfg.get("delete_words") or ()))
+        _RULES[user_id] = rules
+    return rules
+
+
 async def process_text_with_rules(user_id, text):
     if not text:
         return ""
 
     try:
-        replacements = await get_user_data_key(user_id, "replacement_words", {})
-        delete_words = await get_user_data_key(user_id, "delete_words", [])
+        pattern, replacements, delete_words = await get_user_rules(user_id)
 
         processed_text = text
-        for word, replacement in replacements.items():
-            processed_text = processed_text.replace(word, replacement)
+        if pattern is not None:
+            # Single pass over the text; replaced output is never matched again
+            processed_text = pattern.sub(lambda m: replacements[m.group(0)], processed_text)
 
         if delete_words:
             words = processed_text.split()
@@ -545,21 +769,26 @@ async def process_text_with_rules(user_id, text):
         return text
 
 
-async def screenshot(video: str, duration: int, sender: str) -> str | None:
+async def screenshot(video: str, duration: int, sender: str, output_file: str | None = None) -> str | None:
     existing_screenshot = f"{sender}.jpg"
     if os.path.exists(existing_screenshot):
         return existing_screenshot
 
     time_stamp = hhmmss(duration // 2)
-    output_file = datetime.now().isoformat("_", "seconds") + ".jpg"
+    if output_file is None:
+        # Unique per call: concurrent screenshots must never share an output name
+        output_file = f"{uuid.uuid4().hex}.jpg"
 
+    # Scale to Telegram's 320px thumbnail box inside ffmpeg and take the JPEG from stdout
     cmd = [
         "ffmpeg",
         "-ss", time_stamp,
         "-i", video,
         "-frames:v", "1",
-        output_file,
-        "-y"
+        "-vf", "scale=320:320:force_original_aspect_ratio=decrease",
+        "-f", "image2pipe",
+        "-vcodec", "mjpeg",
+        "-"
     ]
 
     process = await asyncio.create_subprocess_exec(
@@ -570,44 +799,81 @@ async def screenshot(video: str, duration: int, sender: str) -> str | None:
 
     stdout, stderr = await process.communicate()
 
-    if os.path.isfile(output_file):
+    if stdout:
+        await asyncio.to_thread(_write_bytes, output_file, stdout)
         return output_file
     else:
         print(f"FFmpeg Error: {stderr.decode().strip()}")
         return None
 
 
-async def get_video_metadata(file_path):
-    default_values = {'width': 1, 'height': 1, 'duration': 1}
-    loop = asyncio.get_event_loop()
-    executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+def _write_bytes(path, data):
+    # Written beside the target and renamed, so readers never see a partial JPEG
+    tmp = f"{path}.{uuid.uuid4().hex}.part"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
 
+
+def _av_metadata(file_path):
     try:
-        def _extract_metadata():
-            try:
-                vcap = cv2.VideoCapture(file_path)
-                if not vcap.isOpened():
-                    return default_values
+        with av.open(file_path, metadata_errors='ignore') as container:
+            stream = container.streams.video[0]
+            if container.duration:
+                duration = round(container.duration / av.time_base)
+            elif stream.duration and stream.time_base:
+                duration = round(float(stream.duration * stream.time_base))
+            else:
+                return None
+            width, height = stream.codec_context.width, stream.codec_context.height
+            if duration <= 0 or not width or not height:
+                return None
+            return {'width': width, 'height': height, 'duration': duration}
+    except Exception as e:
+        logger.error(f"Error in av video_metadata: {e}")
+        return None
 
-                width = round(vcap.get(cv2.CAP_PROP_FRAME_WIDTH))
-                height = round(vcap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-                fps = vcap.get(cv2.CAP_PROP_FPS)
-                frame_count = vcap.get(cv2.CAP_PROP_FRAME_COUNT)
 
-                if fps <= 0:
-                    return default_values
+# Container-level fields only: ffprobe reads the headers without initialising any decoder
+FFPROBE_CMD = (
+    "ffprobe", "-v", "error",
+    "-select_streams", "v:0",
+    "-show_entries", "stream=width,height,duration:format=duration",
+    "-of", "json",
+)
 
-                duration = round(frame_count / fps)
-                if duration <= 0:
-                    return default_values
 
-                vcap.release()
-                return {'width': width, 'height': height, 'duration': duration}
-            except Exception as e:
-                logger.error(f"Error in video_metadata: {e}")
-                return default_values
+def _parse_ffprobe(output):
+    info = orjson.loads(output)
+    stream = (info.get("streams") or [{}])[0]
+    width, height = stream.get("width"), stream.get("height")
+    duration = (info.get("format") or {}).get("duration") or stream.get("duration")
+    if not width or not height or not duration:
+        return None
+    duration = round(float(duration))
+    if duration <= 0:
+        return None
+    return {'width': width, 'height': height, 'duration': duration}
+
+
+async def get_video_metadata(file_path):
+    default_values = {'width': 1, 'height': 1, 'duration': 1}
+    if av is not None:
+        metadata = await asyncio.to_thread(_av_metadata, file_path)
+        if metadata:
+            return metadata
 
-        return await loop.run_in_executor(executor, _extract_metadata)
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *FFPROBE_CMD, file_path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+        if process.returncode != 0:
+            logger.error(f"ffprobe failed for {file_path}: {stderr.decode().strip()}")
+            return default_values
+        return _parse_ffprobe(stdout) or default_values
 
     except Exception as e:
         logger.error(f"Error in get_video_metadata: {e}")
@@ -640,8 +906,8 @@ async def add_premium_user(user_id, duration_value, duration_unit):
             {"user_id": user_id},
             {"$set": {
                 "user_id": user_id,
-                "subscription_start": now.isoformat(), # Store as ISO format string
-                "subscription_end": expiry_date.isoformat(), # Store as ISO format string
+                "subscription_start": int(now.timestamp()),  # unix seconds
+                "subscription_end": int(expiry_date.timestamp()),
             }},
             upsert=True
         )
@@ -654,31 +920,39 @@ async def add_premium_user(user_id, duration_value, duration_unit):
 
 async def is_premium_user(user_id):
     try:
-        user = await premium_users_collection.find_one({"user_id": user_id})
-        if user and "subscription_end" in user:
-            # Convert string datetime to datetime object
-            if isinstance(user["subscription_end"], str):
-                subscription_end = datetime.fromisoformat(user["subscription_end"])
-            else:
-                subscription_end = user["subscription_end"]
-                
-            now = datetime.now()
-            return now < subscription_end
+        user = await cached_user(int(user_id), _find_premium, ttl=PREMIUM_TTL)
+        if user and user["subscription_end"] is not None:
+            # Plain number comparison; no datetime is built for the boolean check
+            return time.time() < user["subscription_end"]
         return False
     except Exception as e:
         logger.error(f"Error checking premium status for {user_id}: {e}")
         return False
 
 
+async def get_transfer_state(src_id, dst_id):
+    # user_id -> subscription_end for whichever of the two has a premium row
+    try:
+        rows = await db_manager._fetchall(
+            "SELECT user_id, subscription_end FROM premium_users WHERE user_id IN (?, ?)", (src_id, dst_id)
+        )
+        return {
+            row[0]: _to_datetime(row[1])
+            for row in rows if row[1]
+        }
+    except Exception as e:
+        logger.error(f"Error getting transfer state for {src_id} -> {dst_id}: {e}")
+        return {}
+
+
 async def get_premium_details(user_id):
     try:
-        user = await premium_users_collection.find_one({"user_id": user_id})
-        if user and "subscription_end" in user:
-            # Convert string datetime to datetime object
-            if isinstance(user["subscription_end"], str):
-                user["subscription_end"] = datetime.fromisoformat(user["subscription_end"])
-            if isinstance(user["subscription_start"], str):
-                user["subscription_start"] = datetime.fromisoformat(user["subscription_start"])
+        user = await cached_user(int(user_id), _find_premium, ttl=PREMIUM_TTL)
+        if user and user["subscription_end"] is not None:
+            user = dict(user)  # the only caller that needs a mutable copy of the cached row
+            # Stored unix seconds become datetimes for display
+            user["subscription_end"] = _to_datetime(user["subscription_end"])
+            user["subscription_start"] = _to_datetime(user["subscription_start"])
             return user
         return None
     except Exception as e: